@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 
+import os
 import re
-from bs4 import BeautifulSoup
+import hashlib
+import time
+import codecs
+import random
+import itertools
+import urllib.error
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.builder import builder_registry
 from urllib.parse import quote
 from datetime import datetime
-from workflow import web, Workflow
+from workflow import web, proxy, Workflow
+import schema
 
 # Initialize workflow and logger
 wf = Workflow()
@@ -24,6 +33,86 @@ HEADERS = {
     'Cache-Control': 'max-age=0'
 }
 MAX_RESULTS = 30
+SEARCH_TIMEOUT = (3, 5)  # (connect, read) seconds
+
+# Hedged search requests: send a duplicate if the first one is slower
+# than this percentile of recorded search latencies
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_HISTORY = 20  # latencies needed before trusting the percentile
+HEDGE_DEFAULT_DELAY = 1.0  # seconds, until then
+LATENCY_HISTORY = 200  # latencies kept
+
+# Retries of failed searches, with jittered exponential backoff
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.25  # seconds, doubled on each retry
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Requests per second and burst size per host, shared by all invocations
+RATE_LIMITS = {
+    'www.amazon.com': (2, 5),
+    'm.media-amazon.com': (20, 60),  # product images
+}
+
+# Hosts the local proxy keeps a connection open to
+PROXY_WARM_URLS = [AMAZON_BASE_URL, 'https://m.media-amazon.com/']
+
+# BeautifulSoup tree builders for search pages, fastest first. The first
+# one installed is used unless the html_parser setting or workflow
+# variable names another (any BeautifulSoup builder feature works)
+PARSER_BACKENDS = ('lxml', 'html.parser')
+DEFAULT_PARSER = next(name for name in PARSER_BACKENDS if builder_registry.lookup(name))
+
+# Not a tree builder: html_parser=stream parses the page as it downloads
+# and stops reading once MAX_RESULTS usable products have been found
+STREAM_PARSER = 'stream'
+STREAM_CHUNK_SIZE = 16384  # bytes read (before decompression) at a time
+
+# Where product fields are found; a valid copy in the data directory
+# overrides the bundled one
+SCHEMA_FILE = 'product_schema.json'
+
+# Kinds of search page, told apart by cheap byte-level markers before parsing
+PAGE_RESULTS = 'results'
+PAGE_EMPTY = 'empty'
+PAGE_BLOCKED = 'blocked'  # robot check / captcha interstitial
+PAGE_ERROR = 'error'
+RESULTS_MARKER = b'data-component-type="s-search-result"'
+BLOCKED_MARKERS = (b'/errors/validateCaptcha', b'<title>Robot Check</title>',
+                   b'To discuss automated access to Amazon data')
+ERROR_MARKERS = (b'Sorry! Something went wrong',)
+
+# Only the main results slot is worth parsing: it starts at the slot's tag
+# and ends at the pagination after the last result
+MAIN_SLOT_MARKER = b's-main-slot'
+RESULTS_END_MARKER = b'data-component-type="s-pagination"'
+
+# A charset declared in the page must be in its first 1024 bytes
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+META_CHARSET_LIMIT = 1024
+
+# Records memoized by a hash of the markup they came from, so pages and
+# product blocks that come back unchanged aren't parsed again
+PARSE_MEMO_DIR = 'parse_memo'
+PARSE_MEMO_ENTRIES = 2000
+# Memoized records also depend on the code that extracted them: the
+# schema filters (and their helpers) in this file and schema.py. They're
+# keyed by its contents, which a copy or checkout doesn't change
+PARSE_CODE_FILES = (__file__, schema.__file__)
+_parse_code_digest = None
+# Markup whose text could hide a container's start or end, so only a
+# product block where each of these is closed can be parsed on its own
+RAW_TEXT_MARKUP = ((b'<script', b'</script'), (b'<style', b'</style'), (b'<!--', b'-->'))
+
+# Stop sending searches for a while after consecutive failures
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 60  # seconds
+
+class SearchPageError(Exception):
+    """Amazon answered with a block or error page instead of search results."""
+    
+    def __init__(self, kind):
+        super().__init__(f"Amazon returned a {kind} page")
+        self.kind = kind
 
 def parse_delivery_date(date_str):
     """Convert delivery date to number of days from today."""
@@ -179,209 +268,523 @@ def shorten_title(title):
     
     return ' '.join(final_parts)
 
-def get_search_results(wf, query):
-    """Get search results from Amazon."""
+def load_search_stats(wf):
+    """Load recorded search latencies and hedging counters."""
+    stats = wf.cached_data('search_stats', max_age=0)
+    if not stats:
+        stats = {'latencies': [], 'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+    return stats
+
+def hedge_delay(stats):
+    """Delay before hedging a search, from the recorded latency percentile."""
+    latencies = sorted(stats['latencies'])
+    if len(latencies) < HEDGE_MIN_HISTORY:
+        return HEDGE_DEFAULT_DELAY
+    index = min(len(latencies) - 1, int(len(latencies) * HEDGE_PERCENTILE / 100))
+    return latencies[index]
+
+def record_search(wf, stats, info):
+    """Record latency and hedging outcome of a search request."""
+    stats['latencies'] = (stats['latencies'] + [info['latency']])[-LATENCY_HISTORY:]
+    stats['requests'] += 1
+    if info['hedged']:
+        stats['hedged'] += 1
+    if info['hedge_won']:
+        stats['hedge_wins'] += 1
+    wf.cache_data('search_stats', stats)
+    
+    hedge_rate = stats['hedged'] / stats['requests']
+    win_rate = stats['hedge_wins'] / stats['hedged'] if stats['hedged'] else 0
+    log.debug(f"Search took {info['latency']:.3f}s; hedge rate {hedge_rate:.1%}, "
+              f"hedge win rate {win_rate:.1%} over {stats['requests']} searches")
+
+def configure_web(wf):
+    """Share network state between invocations through the cache directory."""
+    # Each keystroke is a new process, so keep DNS answers on disk
+    web.dns_cache = web.DNSCache(wf.cachefile('dns.json'))
+
+    # Record traffic to, or replay it from, a fixture directory
+    if os.getenv('web_replay'):
+        latency = float(os.getenv('web_replay_latency') or 0)
+        web.transport = web.ReplayTransport(os.getenv('web_replay'), latency)
+    elif os.getenv('web_record'):
+        web.transport = web.RecordingTransport(os.getenv('web_record'))
+    elif os.getenv('web_proxy'):
+        # Share warm connections and responses between keystrokes
+        address = proxy.get_address(wf)
+        if address:
+            web.transport = web.ProxyTransport(address)
+        else:
+            proxy.start(wf, warm=PROXY_WARM_URLS)
+
+def get_rate_limiter(wf, interactive=True):
+    """Rate limiter for Amazon hosts; interactive requests go before background ones."""
+    return web.RateLimiter(wf.cachefile('rate_limits.json'), RATE_LIMITS, interactive)
+
+def get_parser(wf):
+    """Name of the BeautifulSoup tree builder to parse search pages with."""
+    name = os.getenv('html_parser') or wf.settings.get('html_parser')
+    if not name:
+        return DEFAULT_PARSER
+    if name == STREAM_PARSER:
+        return name
+    if not builder_registry.lookup(name):
+        log.warning(f"HTML parser {name!r} is not available, using {DEFAULT_PARSER!r}")
+        return DEFAULT_PARSER
+    return name
+
+def classify_page(body):
+    """Classify a search page (bytes) as results, empty, blocked or error."""
+    if RESULTS_MARKER in body:
+        return PAGE_RESULTS
+    if any(marker in body for marker in BLOCKED_MARKERS):
+        return PAGE_BLOCKED
+    if any(marker in body for marker in ERROR_MARKERS):
+        return PAGE_ERROR
+    return PAGE_EMPTY
+
+def page_charset(r, body):
+    """Charset of a search page from its Content-Type header or a meta tag.
+
+    Unlike Response.encoding, this only looks for a meta tag where the HTML
+    standard says it must be, rather than searching the whole page. Returns
+    None if neither names a charset Python knows.
+    """
+    # Response.transfer_encoding is the header's charset
+    charset = r.transfer_encoding
+    if not charset:
+        m = META_CHARSET_RE.search(body, 0, META_CHARSET_LIMIT)
+        charset = m.group(1).decode('ascii') if m else None
+    try:
+        return codecs.lookup(charset).name if charset else None
+    except LookupError:
+        return None
+
+def results_start(body, first):
+    """Offset of the tag of the main results slot before the first result, or 0."""
+    slot = body.rfind(MAIN_SLOT_MARKER, 0, first)
+    if slot < 0:
+        return 0
+    return max(body.rfind(b'<', 0, slot), 0)
+
+def results_region(body):
+    """Return (start, end) offsets of the main results in a search page (bytes).
+
+    Found by byte searches rather than parsing. If a marker is missing, the
+    region runs from the start or to the end of the page instead.
+    """
+    first = body.find(RESULTS_MARKER)
+    if first < 0:
+        return 0, len(body)
+    
+    # Containers are all closed by the time the pagination starts, so
+    # cutting the page off there leaves them intact
+    end = body.find(RESULTS_END_MARKER, body.rfind(RESULTS_MARKER))
+    end = body.rfind(b'<', 0, end) if end >= 0 else len(body)
+    return results_start(body, first), end
+
+def sniff_page(r):
+    """Classify a streamed search page, reading no more of it than needed.
+
+    Returns (kind, chunks), where chunks iterates over the (decoded) body
+    from the start of the main results slot, including the part already
+    read. The rest of the page is left for the parser to stop reading.
+    """
+    chunks = r.iter_content(STREAM_CHUNK_SIZE)
+    head = []
+    tail = b''
+    for chunk in chunks:
+        head.append(chunk)
+        # The marker may straddle two chunks
+        window = tail + chunk
+        if RESULTS_MARKER in window:
+            head = b''.join(head)
+            start = results_start(head, head.find(RESULTS_MARKER))
+            return PAGE_RESULTS, itertools.chain([head[start:]], chunks)
+        tail = window[-len(RESULTS_MARKER):]
+    
+    # No results, so the page was small or is of no use beyond its kind
+    body = b''.join(head)
+    return classify_page(body), iter([body])
+
+def fetch_search_page(wf, search_url, deadline=None, interactive=True, stream=False):
+    """Fetch an Amazon search page with retries and a circuit breaker.
+    
+    Returns (response, kind, chunks), where kind is PAGE_RESULTS or
+    PAGE_EMPTY. With stream, the body is only read as far as it takes to
+    tell its kind and chunks iterates over all of it; otherwise chunks is
+    None. Raises `web.CircuitOpenError` without touching the network while
+    recent searches have been failing, `web.RateLimited` if our own rate
+    limit leaves no time to send the request, `SearchPageError` for block
+    and error pages, and the last error if all retries fail.
+    """
+    # Breaker state is shared by all invocations via the cache directory
+    breaker = web.CircuitBreaker(wf.cachefile('search_breaker.json'),
+                                 BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+    breaker.check()
+    
+    stats = load_search_stats(wf)
+    limiter = get_rate_limiter(wf, interactive)
+    attempt = 0
+    chunks = None
+    while True:
+        try:
+            timeout = deadline.timeout(SEARCH_TIMEOUT) if deadline else SEARCH_TIMEOUT
+            # Send a duplicate request if the first one is unusually slow
+            r, info = web.hedged_request('GET', search_url, hedge_delay(stats),
+                                         headers=HEADERS, timeout=timeout,
+                                         allow_redirects=True, limiter=limiter,
+                                         stream=stream, deadline=deadline)
+            record_search(wf, stats, info)
+            r.raise_for_status()
+            if stream:
+                kind, chunks = sniff_page(r)
+            else:
+                kind = classify_page(r.content)
+        except web.RateLimited:
+            # Our own limiter said no, so nothing was sent: retrying only
+            # takes more tokens, and Amazon hasn't failed
+            raise
+        except (urllib.error.URLError, OSError) as e:
+            # Running out of our own latency budget isn't Amazon's fault
+            if isinstance(e, web.Timeout) and deadline and deadline.expired:
+                raise
+            
+            if isinstance(e, urllib.error.HTTPError) and e.code not in RETRY_STATUSES:
+                raise
+            
+            # Full jitter: sleep anywhere up to the exponential backoff
+            delay = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+            if attempt >= MAX_RETRIES or (deadline and deadline.remaining() <= delay):
+                breaker.record_failure()
+                raise
+            
+            attempt += 1
+            log.warning(f"Search failed ({e}), retry {attempt} in {delay:.2f}s")
+            time.sleep(delay)
+            continue
+        
+        # Retrying a block page won't help, but it means we should back off
+        if kind in (PAGE_BLOCKED, PAGE_ERROR):
+            breaker.record_failure()
+            raise SearchPageError(kind)
+        
+        breaker.record_success()
+        return r, kind, chunks
+
+def get_search_results(wf, query, deadline=None, interactive=True):
+    """Get search results from Amazon.
+
+    If a `web.Deadline` is given, the request is cut short when it expires.
+    Background (non-interactive) searches yield to interactive ones when
+    rate-limited.
+    """
     # Build search URL
     search_url = f"{AMAZON_BASE_URL}/s?k={quote(query)}"
     
-    # Get search results
+    parser = get_parser(wf)
+    stream = parser == STREAM_PARSER
+    
+    # Get search results. Fetch errors are raised rather than returned as
+    # "no results", so that they never end up in the cache
+    r, kind, chunks = fetch_search_page(wf, search_url, deadline, interactive, stream)
+    if kind == PAGE_EMPTY:
+        # Nothing to parse
+        return []
+    
     try:
-        # Use workflow's web module to fetch results
-        r = web.get(search_url, headers=HEADERS)
-        r.raise_for_status()
-        html = r.text
+        if stream:
+            parsed = 0
+            def counted(chunks):
+                nonlocal parsed
+                for chunk in chunks:
+                    parsed += len(chunk)
+                    yield chunk
+            
+            try:
+                # No meta tag lookup: the start of the page has gone by
+                return parse_search_stream(counted(chunks), page_charset(r, b''))
+            finally:
+                # Whatever is left of the page isn't needed. Closing an
+                # unfinished response keeps its connection out of the pool
+                log.debug(f"Search {query!r}: parsed {parsed} of {r.bytes_decoded} bytes "
+                          f"fetched ({r.bytes_read} on the wire) before stopping")
+                r.raw.close()
+        
+        body = r.content
         
         # For debugging: save the HTML to a file
-        with open('sample.html', 'w', encoding='utf-8') as f:
-            f.write(html)
+        with open('sample.html', 'wb') as f:
+            f.write(body)
         
-        # Parse HTML
-        soup = BeautifulSoup(html, 'html.parser')
+        start, end = results_region(body)
+        log.debug(f"Search {query!r}: parsed {end - start} of {len(body)} bytes "
+                  f"fetched ({r.bytes_read} on the wire)")
         
-        # Find all product containers
-        products = soup.find_all('div', {'data-component-type': 's-search-result'})
+        # The parser decodes the bytes itself, and the schema normalizes
+        # only the fields that need it, so the page is never decoded or
+        # normalized as a whole
+        return parse_search_memoized(wf, body[start:end], parser, page_charset(r, body))
         
-        results = []
-        for product in products[:MAX_RESULTS]:
-            try:
-                # Get ASIN from data-asin attribute
-                asin = product.get('data-asin')
-                if not asin:
-                    continue
-                
-                # Find title and URL using data-cy=title-recipe
-                title = None
-                url = None
-                
-                # Look for title-recipe div
-                title_recipe = product.find('div', attrs={'data-cy': 'title-recipe'})
-                if title_recipe:
-                    # Get all text from title-recipe
-                    title = ' '.join(title_recipe.stripped_strings)
-                    # Get URL from the link
-                    link = title_recipe.find('a', {'class': 'a-link-normal'})
-                    if link:
-                        url = link.get('href')
-                
-                if not title or not url:
-                    continue
-                
-                # Clean up title
-                if title:
-                    # Remove extra whitespace and newlines
-                    title = ' '.join(title.split())
-                    # Check if item is sponsored (with or without brackets)
-                    is_sponsored = bool(re.search(r'(?:\[)?Sponsored(?:\])?', title))
-                    # Remove sponsored tag if present (with or without brackets)
-                    title = re.sub(r'\s*(?:\[)?Sponsored(?:\])?\s*', '', title)
-                    # Remove ad relevance text
-                    title = re.sub(r"You\u2019re seeing this ad based on the product\u2019s relevance to your search query.", '', title)
-                    # Remove leave ad feedback text
-                    title = re.sub(r'Leave ad feedback', '', title)
-                    # Remove any other common tags
-                    title = re.sub(r'\s*\[(New|Limited Time|Sale|Deal|Prime)\]\s*', '', title)
-                
-                # Clean up title and URL
-                title = title.strip()
-                url = normalize_amazon_url(url, asin)
-                
-                # Extract price
-                price_elem = product.find('span', {'class': 'a-price'})
-                if price_elem:
-                    price_span = price_elem.find('span', {'class': 'a-offscreen'})
-                    price = price_span.get_text().strip() if price_span else None
+    except web.Timeout:
+        # Let the caller fall back to cached results
+        raise
+    except Exception:
+        return []
+
+def parse_search_results(html, parser=None, encoding=None):
+    """Return product records found in a search results page.
+
+    html is str, or bytes in the given encoding (which the parser guesses
+    if it's None). parser is the name of a BeautifulSoup tree builder or
+    STREAM_PARSER; defaults to the fastest tree builder installed.
+    """
+    return [record for record in parse_containers(html, parser, encoding) if record]
+
+def parse_containers(html, parser=None, encoding=None, limit=MAX_RESULTS):
+    """Return the record (or None if it isn't usable) of each product container in a page.
+
+    Containers after the one giving the limit-th usable record aren't
+    extracted; None for no limit. Other arguments are as for
+    parse_search_results().
+    """
+    product_schema = load_schema()
+    if parser == STREAM_PARSER:
+        text = [html]
+        if isinstance(html, bytes):
+            text = codecs.iterdecode(text, encoding or 'utf-8', errors='replace')
+        containers = schema.iter_containers(product_schema, text)
+        return list(take_usable(product_records(containers, product_schema), limit))
+    
+    # Decoding a known charset here is quicker than BeautifulSoup's own
+    # handling of bytes
+    if isinstance(html, bytes) and encoding:
+        html = html.decode(encoding, errors='replace')
+    
+    # Only product containers are turned into a tree; the rest of the page
+    # (navigation, scripts, carousels, footer) is skipped while parsing
+    name, attrs = product_schema.strainer_args()
+    soup = BeautifulSoup(html, parser or DEFAULT_PARSER, parse_only=SoupStrainer(name, attrs=attrs))
+    
+    # Find all product containers
+    products = soup.find_all(name, attrs)
+    results = list(take_usable(product_records(products, product_schema), limit))
+    
+    # Records hold plain strings, so the tree can go now rather than
+    # whenever the garbage collector gets to its reference cycles
+    soup.decompose()
+    
+    return results
+
+def parse_search_stream(chunks, encoding=None):
+    """Return product records from a search page arriving as chunks of bytes.
+
+    Each product is extracted as soon as its container closes, and no more
+    chunks are read once MAX_RESULTS usable ones have been found, so parsing
+    overlaps the download and memory use doesn't depend on page size.
+    """
+    product_schema = load_schema()
+    text = codecs.iterdecode(chunks, encoding or 'utf-8', errors='replace')
+    return extract_products(schema.iter_containers(product_schema, text), product_schema)
+
+def parse_code_digest():
+    """Digest of the code records are extracted with, read once per process."""
+    global _parse_code_digest
+    if _parse_code_digest is None:
+        digest = hashlib.sha1()
+        for path in PARSE_CODE_FILES:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        _parse_code_digest = digest.hexdigest()
+    return _parse_code_digest
+
+def parse_search_memoized(wf, html, parser=None, encoding=None):
+    """Return product records in the main results of a page (bytes), reusing memoized ones.
+
+    The page as a whole is looked up first, then its product blocks in
+    turn until there are MAX_RESULTS usable records, so that only blocks
+    not seen before are parsed. Arguments are as for parse_search_results().
+    """
+    product_schema = load_schema()
+    memo = schema.Memo(wf.cachefile(PARSE_MEMO_DIR), PARSE_MEMO_ENTRIES)
+    stats = load_memo_stats(wf)
+    # Deliveries are counted from today
+    salt = (f'{product_schema.digest}:{parse_code_digest()}:{parser}:{encoding}:'
+            f'{datetime.now():%Y-%m-%d}')
+    
+    page_key = memo.key(salt, html)
+    results = memo.get(page_key)
+    stats['pages'] += 1
+    if results is not None:
+        stats['page_hits'] += 1
+        record_memo(wf, stats)
+        return results
+    
+    # A guessed charset might not be the same for a block as for the page
+    blocks = product_blocks(html, product_schema) if encoding else None
+    if blocks:
+        missing = object()
+        records = []
+        found = 0
+        while len(records) < len(blocks) and found < MAX_RESULTS:
+            # Look blocks up until there would be enough records if all
+            # those missed were usable. Unusable blocks are memoized too,
+            # as None
+            missed = []
+            while len(records) < len(blocks) and found + len(missed) < MAX_RESULTS:
+                key = memo.key(salt, blocks[len(records)])
+                record = memo.get(key, missing)
+                stats['blocks'] += 1
+                if record is missing:
+                    missed.append((len(records), key))
                 else:
-                    price = None
-                
-                # Skip items with no price or zero price
-                if not price:
-                    continue
-                    
-                # Try to convert price to float for comparison (remove $ and ,)
-                try:
-                    price_float = float(price.replace('$', '').replace(',', ''))
-                    if price_float <= 0:
-                        continue
-                except ValueError:
-                    continue
-                
-                # Extract coupon if present
-                coupon = None
-                coupon_elem = product.find('span', {'class': 's-coupon-unclipped'})
-                if coupon_elem:
-                    coupon_text = coupon_elem.get_text().strip()
-                    # Clean up coupon text
-                    coupon_text = re.sub(r'\s+', ' ', coupon_text)  # Normalize whitespace
-                    coupon_text = re.sub(r'^Save\s+', '', coupon_text)  # Remove "Save" prefix
-                    coupon_text = re.sub(r'^Get\s+', '', coupon_text)  # Remove "Get" prefix
-                    coupon_text = coupon_text.strip()
-                    if coupon_text:
-                        coupon = coupon_text
-                
-                # Extract delivery info
-                delivery = None
-                delivery_recipe = product.find('div', attrs={'data-cy': 'delivery-recipe'})
-                if delivery_recipe:
-                    delivery_text = ' '.join(delivery_recipe.stripped_strings)
-                    # Try to find fastest delivery date
-                    date_patterns = [
-                        r'(?:fastest|FREE) delivery ([A-Za-z]+,?\s+[A-Za-z]+\s+\d+)',
-                        r'Get it by ([A-Za-z]+,?\s+[A-Za-z]+\s+\d+)',
-                        r'Arrives by ([A-Za-z]+,?\s+[A-Za-z]+\s+\d+)',
-                        r'Delivery ([A-Za-z]+,?\s+[A-Za-z]+\s+\d+)'
-                    ]
-                    
-                    earliest_date = None
-                    earliest_days = float('inf')
-                    
-                    # First check for immediate delivery options
-                    if 'FREE delivery tomorrow' in delivery_text:
-                        delivery = "Delivery tomorrow"
-                    elif 'FREE delivery today' in delivery_text:
-                        delivery = "Delivery today"
-                    else:
-                        # Check all date patterns
-                        for pattern in date_patterns:
-                            date_matches = re.finditer(pattern, delivery_text)
-                            for match in date_matches:
-                                delivery_date = match.group(1)
-                                parsed_date = parse_delivery_date(delivery_date)
-                                # Extract number of days from the parsed date
-                                if parsed_date.startswith('Delivery in '):
-                                    days = int(parsed_date.split()[2])
-                                    if days < earliest_days:
-                                        earliest_days = days
-                                        earliest_date = parsed_date
-                                elif parsed_date in ['Delivery today', 'Delivery tomorrow']:
-                                    days = 0 if parsed_date == 'Delivery today' else 1
-                                    if days < earliest_days:
-                                        earliest_days = days
-                                        earliest_date = parsed_date
-                        
-                        if earliest_date:
-                            delivery = earliest_date
-                
-                # Extract rating
-                rating_elem = product.find('span', {'class': 'a-icon-alt'})
-                rating = rating_elem.get_text().strip() if rating_elem else None
-                
-                # Extract review count - try multiple methods
-                review_count = None
-                # Method 1: Look for review count in aria-label
-                review_link = product.find('a', {'href': lambda x: x and 'customerReviews' in x})
-                if review_link:
-                    review_span = review_link.find('span', {'aria-label': True})
-                    if review_span:
-                        count_match = re.search(r'([\d,]+)\s+ratings?', review_span.get('aria-label', ''))
-                        if count_match:
-                            review_count = count_match.group(1)
-                
-                # Method 2: Look for review count in specific spans
-                if not review_count:
-                    review_spans = product.find_all('span', {'class': ['a-size-base', 's-underline-text']})
-                    for span in review_spans:
-                        text = span.get_text().strip()
-                        # Match numbers with optional commas
-                        count_match = re.match(r'^([\d,]+)$', text)
-                        if count_match:
-                            review_count = count_match.group(1)
-                            break
-                
-                # Method 3: Look for review count in parentheses
-                if not review_count:
-                    for span in product.find_all('span'):
-                        text = span.get_text().strip()
-                        count_match = re.search(r'\(([\d,]+)\s*\)', text)
-                        if count_match and span.find_parent('a', {'href': lambda x: x and 'customerReviews' in x}):
-                            review_count = count_match.group(1)
-                            break
-                
-                # Extract image URL
-                image_elem = product.find('img', {'class': 's-image'})
-                image_url = image_elem['src'] if image_elem else None
-                
-                # Create result dictionary
-                result = {
-                    'title': title,
-                    'url': url,
-                    'price': price,
-                    'coupon': coupon,
-                    'delivery': delivery,
-                    'stars': rating,
-                    'reviews': review_count,
-                    'image_url': image_url,
-                    'asin': asin,
-                    'sponsored': is_sponsored
-                }
-                
-                # Only add items that have at least a title and URL
-                if result['title'] and result['url']:
-                    results.append(result)
-                
-            except Exception:
+                    stats['block_hits'] += 1
+                    found += bool(record)
+                records.append(record)
+            if not missed:
                 continue
-        
-        return results
-        
-    except Exception:
-        return [] 
\ No newline at end of file
+            
+            # The blocks missed are parsed together, as one short page
+            parsed = parse_containers(b''.join(blocks[i] for i, key in missed), parser, encoding, None)
+            if len(parsed) != len(missed):
+                records = None
+                break
+            for (i, key), record in zip(missed, parsed):
+                records[i] = record
+                memo.set(key, record)
+                found += bool(record)
+        if records is not None:
+            results = [record for record in records if record]
+    
+    if results is None:
+        results = parse_search_results(html, parser, encoding)
+    memo.set(page_key, results)
+    memo.prune()
+    record_memo(wf, stats)
+    return results
+
+def product_blocks(html, product_schema):
+    """Split the main results of a page (bytes) into product blocks.
+
+    A block runs from the start tag of a product container to that of the
+    next one, or to the end. Returns None unless the start and end tags of
+    the container's kind balance in every block, as they don't if
+    containers nest or the last one runs on past the results, and scripts,
+    styles and comments are closed in every block and before the first.
+    """
+    starts = []
+    at = html.find(RESULTS_MARKER)
+    while at >= 0:
+        starts.append(html.rfind(b'<', 0, at))
+        at = html.find(RESULTS_MARKER, at + len(RESULTS_MARKER))
+    if not starts:
+        return None
+    blocks = [html[start:end] for start, end in zip(starts, starts[1:] + [len(html)])]
+    
+    tag = product_schema.container.tag.encode('ascii')
+    balanced = ((b'<' + tag, b'</' + tag),) + RAW_TEXT_MARKUP
+    if not all(html.count(start, 0, starts[0]) == html.count(end, 0, starts[0])
+               for start, end in RAW_TEXT_MARKUP):
+        return None
+    if not all(block.count(start) == block.count(end) for block in blocks for start, end in balanced):
+        return None
+    return blocks
+
+def load_memo_stats(wf):
+    """Load hit counters of the parse memo."""
+    stats = wf.cached_data('parse_memo_stats', max_age=0)
+    if not stats:
+        stats = {'pages': 0, 'page_hits': 0, 'blocks': 0, 'block_hits': 0}
+    return stats
+
+def record_memo(wf, stats):
+    """Record hit counters of the parse memo and log its hit rate."""
+    wf.cache_data('parse_memo_stats', stats)
+    
+    block_rate = stats['block_hits'] / stats['blocks'] if stats['blocks'] else 0
+    log.debug(f"Parse memo hit rate {stats['page_hits'] / stats['pages']:.1%} for pages "
+              f"over {stats['pages']} searches, {block_rate:.1%} for product blocks "
+              f"of the rest")
+
+def extract_products(products, product_schema):
+    """Return records for the first MAX_RESULTS usable product containers."""
+    return [record for record in take_usable(product_records(products, product_schema)) if record]
+
+def take_usable(records, limit=MAX_RESULTS):
+    """Yield from records (None for unusable containers) until limit usable ones have gone by.
+
+    Stops without taking another from records, so that no more containers
+    are extracted (or, when streaming, read) than needed. None for no limit.
+    """
+    found = 0
+    for record in records:
+        yield record
+        found += bool(record)
+        if found == limit:
+            return
+
+def product_records(products, product_schema):
+    """Yield the record for each product container, or None if it isn't usable."""
+    for product in products:
+        try:
+            yield parse_product(product, product_schema)
+        except Exception:
+            yield None
+
+def parse_product(product, product_schema=None):
+    """Return the record for a product container, or None if it isn't usable."""
+    return (product_schema or load_schema()).extract(product)
+
+def positive_price(value, raw):
+    """Schema filter: the price, if it is a number above zero."""
+    # Try to convert price to float for comparison (remove $ and ,)
+    try:
+        if float(value.replace('$', '').replace(',', '')) > 0:
+            return value
+    except ValueError:
+        pass
+    return None
+
+def amazon_url(value, raw):
+    """Schema filter: canonical affiliate URL of the product."""
+    return normalize_amazon_url(value, raw['asin'])
+
+def fastest_delivery(value, raw, immediate=(), patterns=()):
+    """Schema filter: the soonest delivery mentioned in the delivery text."""
+    # First check for immediate delivery options
+    for text, delivery in immediate:
+        if text in value:
+            return delivery
+    
+    earliest_date = None
+    earliest_days = float('inf')
+    for pattern in patterns:
+        for match in pattern.finditer(value):
+            parsed_date = parse_delivery_date(match.group(1))
+            # Extract number of days from the parsed date
+            if parsed_date.startswith('Delivery in '):
+                days = int(parsed_date.split()[2])
+            elif parsed_date in ['Delivery today', 'Delivery tomorrow']:
+                days = 0 if parsed_date == 'Delivery today' else 1
+            else:
+                continue
+            if days < earliest_days:
+                earliest_days = days
+                earliest_date = parsed_date
+    return earliest_date
+
+SCHEMA_FILTERS = {
+    'positive_price': positive_price,
+    'amazon_url': amazon_url,
+    'fastest_delivery': fastest_delivery,
+}
+
+def load_schema():
+    """Compiled product schema, recompiled only when its file changes."""
+    override = os.path.join(wf.datadir, SCHEMA_FILE)
+    if os.path.exists(override):
+        try:
+            return schema.load(override, SCHEMA_FILTERS)
+        except (OSError, schema.SchemaError) as e:
+            log.error(f"Ignoring invalid schema {override}: {e}")
+    return schema.load(os.path.join(os.path.dirname(os.path.abspath(__file__)), SCHEMA_FILE), SCHEMA_FILTERS)
@@ -5,14 +5,26 @@
 
 Usage:
     amazon.py <query> [srt:<sort>] [dl:<days>]
+    amazon.py --refresh <query>
 """
 
 import sys
 import os
+import asyncio
+import hashlib
 from workflow import Workflow, ICON_WEB, web
+from workflow.background import run_in_background, is_running
 import amazon
 
 CACHE_AGE = 1800  # 30 minutes
+EMPTY_CACHE_AGE = 300  # 5 minutes for searches without results
+IMAGE_CACHE_AGE = 604800  # 1 week
+MAX_IMAGE_DOWNLOADS = 8  # concurrent thumbnail downloads
+IMAGE_TIMEOUT = (2, 5)  # (connect, read) seconds
+MAX_IMAGE_BYTES = 1024 * 1024  # thumbnails are a few KB; don't let a bad one stall the filter
+# Time allowed for fetching before showing whatever is ready (ms)
+LATENCY_BUDGET = float(os.getenv('latency_budget', '800')) / 1000
+RERUN_INTERVAL = 1  # seconds between Alfred re-runs while refreshing
 
 def parse_delivery_days(delivery_str):
     """Convert delivery string to number of days."""
@@ -66,26 +78,134 @@ def parse_query_params(query):
     
     return search_query, sort_key, sort_reverse, max_delivery_days
 
-def download_image(url, asin):
-    """Download an image from URL and save it to a temporary file using ASIN as filename."""
+async def fetch_image(item, **kwargs):
+    """Download the image of item to a temporary file using ASIN as filename and return its path."""
+    r = await web.aget(item['image_url'], stream=True, max_bytes=MAX_IMAGE_BYTES, **kwargs)
+    r.raise_for_status()
+
+    # Create a temporary file with .png extension using ASIN
+    img_path = os.path.join(os.getenv('TMPDIR', '/tmp'), f"{item['asin']}.png")
+
+    # Stream the image to disk; the file only appears once complete.
+    # Not asyncio.to_thread(): asyncio.run() waits for its executor to
+    # finish, which would hold a slow body past the deadline
+    await r.asave_to_path(img_path)
+
+    return img_path
+
+def download_images(wf, items, deadline=None, interactive=True, fetch=True):
+    """Return ({asin: image path}, complete) for items, downloading missing images concurrently.
+
+    If a `web.Deadline` is given, images not downloaded by then are left out
+    and `complete` is False. Without fetch, only cached images are used.
+    """
+    icons = {}
+    missing = []
+    for item in items:
+        if item.get('image_url') and item.get('asin'):
+            # Images are cached using ASIN as the key
+            path = wf.cached_data(f"img_{item['asin']}", max_age=IMAGE_CACHE_AGE)
+            if path:
+                icons[item['asin']] = path
+            else:
+                missing.append(item)
+
+    if not missing:
+        return icons, True
+
+    if not fetch or (deadline and deadline.expired):
+        return icons, False
+
+    # Thumbnails rarely change, so expired ones are only revalidated
+    http_cache = web.HTTPCache(wf.cachefile('http'))
+    timeout = deadline.timeout(IMAGE_TIMEOUT) if deadline else IMAGE_TIMEOUT
+    limiter = amazon.get_rate_limiter(wf, interactive)
+    paths = asyncio.run(web.gather(
+        *(fetch_image(item, timeout=timeout, cache=http_cache, limiter=limiter)
+          for item in missing),
+        limit=MAX_IMAGE_DOWNLOADS,
+        return_exceptions=True,
+        timeout=deadline.remaining() if deadline else None
+    ))
+    http_cache.prune()
+
+    complete = True
+    for item, path in zip(missing, paths):
+        try:
+            if isinstance(path, (asyncio.CancelledError, web.Timeout)):
+                # Out of time; leave it to the background refresh
+                complete = False
+                continue
+            if isinstance(path, BaseException):
+                raise path
+        except Exception as e:
+            log.error(f"Error downloading image {item['image_url']}: {str(e)}")
+            continue
+        wf.cache_data(f"img_{item['asin']}", path)
+        icons[item['asin']] = path
+
+    return icons, complete
+
+def search_cache_key(search_query):
+    """Name of the cached results of search_query."""
+    return f'search_{search_query}'
+
+def search(wf, search_query, deadline=None, interactive=True):
+    """Return (results, partial) for search_query, from the cache or Amazon.
+    
+    Falls back to stale cached results if Amazon is slow or failing; results
+    is None if there are none. partial is True if the search ran out of time
+    and should be finished in the background.
+    """
+    cache_key = search_cache_key(search_query)
+    cached = wf.cached_data(cache_key, max_age=0)
+    # Empty results are only cached briefly; block and error pages never are
+    if cached is not None and wf.cached_data_age(cache_key) < (CACHE_AGE if cached else EMPTY_CACHE_AGE):
+        return cached, False
+    
     try:
-        # Download image
-        r = web.get(url)
-        r.raise_for_status()
-        
-        # Create a temporary file with .png extension using ASIN
-        img_path = os.path.join(os.getenv('TMPDIR', '/tmp'), f"{asin}.png")
-        
-        # Save the image
-        with open(img_path, 'wb') as f:
-            f.write(r.content)
-            
-        return img_path
+        results = amazon.get_search_results(wf, search_query, deadline, interactive)
+    except web.Timeout as e:
+        log.warning(f"Search timed out: {e}")
+        return cached, True
+    except web.CircuitOpenError as e:
+        # Amazon has been failing: don't wait for it, serve what we have
+        log.warning(f"Not searching Amazon: {e}")
+        return cached, False
     except Exception as e:
-        log.error(f"Error downloading image {url}: {str(e)}")
-        return None
+        if cached is None:
+            raise
+        log.error(f"Search failed, using cached results: {e}")
+        return cached, False
+    
+    wf.cache_data(cache_key, results)
+    return results, False
+
+def refresh_job_name(search_query):
+    """Name of the background job refreshing search_query."""
+    return 'refresh_' + hashlib.md5(search_query.encode('utf-8')).hexdigest()
+
+def refresh(wf, search_query):
+    """Fetch and cache results and images for search_query without a deadline."""
+    # Runs in the background, so let interactive requests go first
+    results, _ = search(wf, search_query, interactive=False)
+    download_images(wf, results or [], interactive=False)
+
+def refresh_in_background(wf, search_query):
+    """Finish fetching search_query in the background and make Alfred re-run."""
+    name = refresh_job_name(search_query)
+    if not is_running(name):
+        run_in_background(name, [sys.executable, 'filter.py', '--refresh', search_query])
+    wf.rerun = RERUN_INTERVAL
 
 def main(wf):
+    amazon.configure_web(wf)
+    
+    # Background refresh started by an earlier run
+    if len(wf.args) == 2 and wf.args[0] == '--refresh':
+        refresh(wf, wf.args[1])
+        return 0
+
     # Get query from user
     query = wf.args[0] if wf.args else None
     
@@ -98,13 +218,29 @@ def main(wf):
             # Parse query parameters
             search_query, sort_key, sort_reverse, max_delivery_days = parse_query_params(query)
             
-            # Create cache key from base search query (without modifiers)
-            cache_key = f'search_{search_query}'
+            # Everything below has to be ready within the latency budget
+            deadline = web.Deadline(LATENCY_BUDGET)
             
-            # Try to get results from cache
-            results = wf.cached_data(cache_key, lambda: amazon.get_search_results(wf, search_query), max_age=CACHE_AGE)
+            # While a background job is fetching this search, it has the
+            # network to itself: reruns show what's cached until it's done
+            refreshing = is_running(refresh_job_name(search_query))
+            if refreshing:
+                results, partial = wf.cached_data(search_cache_key(search_query), max_age=0), True
+            else:
+                # Try to get results from cache (keyed on the query without modifiers)
+                results, partial = search(wf, search_query, deadline)
             
-            if not results:
+            if results is None and partial:
+                results = []
+                wf.add_item('Searching Amazon...',
+                           f'Waiting for results for "{search_query}"',
+                           icon=ICON_WEB)
+            elif results is None:
+                results = []
+                wf.add_item('Amazon is not responding',
+                           'Try again in a minute',
+                           icon=ICON_WEB)
+            elif not results:
                 wf.add_item('No results found',
                            'Try a different search term',
                            icon=ICON_WEB)
@@ -139,6 +275,15 @@ def main(wf):
                 else:  # price
                     results.sort(key=lambda x: float(x.get('price', '0').replace('$', '').replace(',', '')), reverse=sort_reverse)
             
+            # Fetch all product images at once; missing ones get a placeholder
+            icons, complete = download_images(wf, results, deadline, fetch=not refreshing)
+            if not complete:
+                partial = True
+            
+            # Let a background job finish and have Alfred pick up its results
+            if partial or refreshing:
+                refresh_in_background(wf, search_query)
+            
             for item in results:
                 # Shorten the title intelligently
                 shortened_title = amazon.shorten_title(item['title'])
@@ -203,18 +348,8 @@ def main(wf):
                 
                 subtitle = '   '.join(filter(None, subtitle_parts)) if subtitle_parts else 'No additional information available'
                 
-                # Get icon from product image
-                icon = ICON_WEB
-                if item.get('image_url') and item.get('asin'):
-                    # Cache the image using ASIN as the key
-                    icon = wf.cached_data(
-                        f"img_{item['asin']}",  # Use ASIN as unique key
-                        lambda: download_image(item['image_url'], item['asin']),
-                        max_age=604800  # Cache for 1 week
-                    )
-                    # If image download/cache failed, use default icon
-                    if not icon:
-                        icon = ICON_WEB
+                # Get icon from product image, or use default icon if download failed
+                icon = icons.get(item.get('asin')) or ICON_WEB
                 
                 wf.add_item(
                     title=shortened_title,
@@ -228,6 +363,18 @@ def main(wf):
                        str(e),
                        icon=ICON_WEB)
 
+    stats = web.pool_stats()
+    log.debug(f"Connections: {stats['connections']} opened, {stats['reused']} reused "
+              f"({stats['handshakes_saved']} handshakes saved)")
+    tls = web.tls_stats()
+    log.debug(f"TLS handshakes: {tls['resumed']} resumed, {tls['full']} full")
+    for host, t in web.timing_stats().items():
+        n = t['requests']
+        log.debug(f"{host}: {n} requests ({t['reused']} reused), avg dns {t['dns'] / n * 1000:.0f}ms, "
+                  f"connect {t['connect'] / n * 1000:.0f}ms, tls {t['tls'] / n * 1000:.0f}ms, "
+                  f"ttfb {t['ttfb'] / n * 1000:.0f}ms, transfer {t['transfer'] / n * 1000:.0f}ms, "
+                  f"{t['bytes_read']} bytes on wire")
+
     wf.send_feedback()
     return 0
 
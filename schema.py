@@ -0,0 +1,680 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""Declarative extraction of records from product containers.
+
+A schema is a JSON file naming the container element and, for each
+record field, where its value comes from:
+
+    {
+      "container": "div[data-component-type=s-search-result]",
+      "fields": {
+        "title": {
+          "required": true,
+          "sources": [{"path": ["div[data-cy=title-recipe]"], "value": "strings"}],
+          "post": [{"filter": "normalize_space"}, {"sub": "Sponsored"}]
+        },
+        ...
+      }
+    }
+
+Sources are tried in order until one gives a value:
+
+- "path": selectors, each matched against the descendants of the first
+  match of the one before (like chained find() calls). An empty path is
+  the container itself.
+- "each": a selector; its matches (optionally only those "within" an
+  element matching another selector) are tried in document order.
+
+"value" is "text" (stripped get_text()), "strings" (stripped strings
+joined by spaces) or "@attribute". A "regex" must match the value, and
+its first group (if any) becomes the value. A source that finds nothing
+(or whose regex doesn't match) falls through to the next; an empty
+value doesn't. With "strict": true, an element lacking the "@attribute"
+drops the record instead. "post" steps then rewrite the value:
+{"sub": regex, "repl": ""} or {"filter": name, ...args} (a "patterns"
+argument is compiled to regexes along with the schema).
+Fields of "type": "flag" are True if their "test" regex matches.
+
+Selectors are tag.class[attr][attr=value][attr*=value], with commas
+separating alternatives. Records whose required fields are empty, before
+or after post-processing, are dropped.
+
+Schemas are compiled once per process and recompiled when the file
+changes, so markup changes only need a new schema file.
+
+Containers can come from a BeautifulSoup tree or, with iter_containers(),
+straight from a page as it is downloaded. A Memo keeps records on disk
+by a hash of the markup they came from, so it needn't be parsed again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import unicodedata
+from html.parser import HTMLParser
+
+from bs4 import CData, NavigableString
+from bs4.builder import HTMLTreeBuilder
+
+from workflow.util import atomic_writer
+
+log = logging.getLogger(__name__)
+
+# Fields every record has, in order, and those it can't do without
+RECORD_FIELDS = ('title', 'url', 'price', 'coupon', 'delivery', 'stars',
+                 'reviews', 'image_url', 'asin', 'sponsored')
+REQUIRED_FIELDS = ('title', 'url', 'price', 'asin')
+
+# Text nodes that count as text, as for Tag.get_text() (so not comments,
+# scripts or styles); plain str for trees not built by BeautifulSoup
+TEXT_TYPES = (str, NavigableString, CData)
+
+_selector_re = re.compile(r'''
+    ([\w-]+)?                                   # tag
+    ((?:\.[\w-]+)*)                             # classes
+    ((?:\[[\w-]+(?:\*?=[^\]]*)?\])*)            # attribute tests
+    $''', re.VERBOSE)
+_attr_test_re = re.compile(r'\[([\w-]+)(?:(\*?=)([^\]]*))?\]')
+
+# Compiled schemas by path: (mtime, Schema)
+_compiled = {}
+
+# As for BeautifulSoup: elements without end tags, and those whose
+# strings aren't text
+VOID_ELEMENTS = frozenset(HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS)
+NON_TEXT_ELEMENTS = frozenset(HTMLTreeBuilder.DEFAULT_STRING_CONTAINERS)
+PRESERVE_WHITESPACE_ELEMENTS = frozenset(HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS)
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+
+class SchemaError(ValueError):
+    """Raised for a schema that is malformed or lacks required fields."""
+
+
+class Selector:
+    """A compound selector such as a.a-link-normal[href*=customerReviews]."""
+
+    def __init__(self, text):
+        m = _selector_re.match(text.strip())
+        if not m or not text.strip():
+            raise SchemaError(f'invalid selector: {text!r}')
+        tag, classes, tests = m.groups()
+        self.text = text.strip()
+        self.tag = tag
+        self.classes = [c for c in classes.split('.') if c]
+        self.tests = [(name, op, value.strip('"\'') if value else value)
+                      for name, op, value in _attr_test_re.findall(tests)]
+
+    def matches(self, attrs):
+        """True if an element with attrs (its tag already matched) matches."""
+        if self.classes:
+            classes = attrs.get('class') or ()
+            if isinstance(classes, str):
+                classes = classes.split()
+            for c in self.classes:
+                if c not in classes:
+                    return False
+        for name, op, value in self.tests:
+            actual = attrs.get(name)
+            if actual is None:
+                return False
+            if op == '=' and actual != value:
+                return False
+            if op == '*=' and value not in actual:
+                return False
+        return True
+
+
+class Source:
+    """One way of finding a field's value."""
+
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            raise SchemaError(f'source must be an object: {spec!r}')
+        if 'each' in spec:
+            self.kind = 'each'
+            self.steps = [_alternatives(spec['each'])]
+            self.within = _alternatives(spec['within']) if 'within' in spec else None
+        else:
+            self.kind = 'path'
+            self.steps = [_alternatives(step) for step in spec.get('path', [])]
+            self.within = None
+        value = spec.get('value', 'text')
+        if value not in ('text', 'strings') and not value.startswith('@'):
+            raise SchemaError(f'invalid value {value!r}')
+        self.value = value
+        self.strict = bool(spec.get('strict'))
+        self.regex = _compile(spec['regex']) if 'regex' in spec else None
+
+
+class Field:
+    """A record field: its sources in fallback order and post-processing."""
+
+    def __init__(self, name, spec, filters):
+        if not isinstance(spec, dict) or not spec.get('sources'):
+            raise SchemaError(f'field {name!r} has no sources')
+        self.name = name
+        self.required = bool(spec.get('required'))
+        self.flag = spec.get('type') == 'flag'
+        self.test = _compile(spec['test']) if self.flag else None
+        self.sources = [Source(source) for source in spec['sources']]
+        self.post = []
+        for step in spec.get('post', []):
+            if 'sub' in step:
+                self.post.append(('sub', _compile(step['sub']), step.get('repl', '')))
+            elif step.get('filter') in filters:
+                args = {k: v for k, v in step.items() if k != 'filter'}
+                if 'patterns' in args:
+                    args['patterns'] = [_compile(pattern) for pattern in args['patterns']]
+                self.post.append(('filter', filters[step['filter']], args))
+            else:
+                raise SchemaError(f'field {name!r}: unknown post step {step!r}')
+
+
+class _Scan:
+    """State of one walk of a container."""
+
+    def __init__(self, schema, container):
+        self.strings = []
+        # Path sources: [matched steps, still inside last match, element, text range]
+        self.paths = [[0, True, container, [0, None]] for _ in schema.paths]
+        # Each sources: [(element, text range)] in document order
+        self.each = [[] for _ in schema.each]
+        self.within = [0] * len(schema.each)
+        self.schema = schema
+        self._walk(container)
+        for state in self.paths:
+            if state[3][1] is None:
+                state[3][1] = len(self.strings)
+
+    def _walk(self, node):
+        strings = self.strings
+        index = self.schema.index
+        anywhere = index.get(None, ())
+        for child in node.contents:
+            if isinstance(child, str):
+                if type(child) in TEXT_TYPES:
+                    strings.append(child)
+                continue
+
+            exits = None
+            attrs = child.attrs
+            for kind, i, step, selectors in index.get(child.name, anywhere):
+                # Cheap state checks first; most entries are settled
+                if kind == 'path':
+                    state = self.paths[i]
+                    # Each step matches below the previous one, not on it
+                    if not state[1] or state[0] != step or state[2] is child:
+                        continue
+                elif kind == 'each':
+                    if self.schema.each[i].within is not None and not self.within[i]:
+                        continue
+                for selector in selectors:
+                    if selector.matches(attrs):
+                        break
+                else:
+                    continue
+                if exits is None:
+                    exits = []
+                if kind == 'path':
+                    state[0] += 1
+                    state[2] = child
+                    rng = state[3] = [len(strings), None]
+                    exits.append((state, rng))
+                elif kind == 'each':
+                    rng = [len(strings), None]
+                    self.each[i].append((child, rng))
+                    exits.append((None, rng))
+                else:
+                    exits.append((i, None))
+
+            if exits:
+                # Ancestors only: the element itself isn't "within" itself
+                for i, rng in exits:
+                    if rng is None:
+                        self.within[i] += 1
+
+            if child.contents:
+                self._walk(child)
+
+            if exits:
+                for state, rng in exits:
+                    if rng is None:
+                        self.within[state] -= 1
+                        continue
+                    rng[1] = len(strings)
+                    if state is not None:
+                        # Left the last match: deeper steps can't match now
+                        state[1] = False
+
+    def value(self, element, rng, spec):
+        """Value of element per spec, or None."""
+        if spec.value.startswith('@'):
+            name = spec.value[1:]
+            if spec.strict:
+                return element.attrs[name]
+            return element.attrs.get(name)
+        strings = self.strings[rng[0]:rng[1]]
+        if spec.value == 'strings':
+            return ' '.join(s.strip() for s in strings if s.strip())
+        return ''.join(strings).strip()
+
+
+class Schema:
+    """A compiled schema; see the module docstring.
+
+    Args:
+        data (dict): Parsed schema file.
+        filters (dict): Functions for "filter" post steps by name, called
+            as func(value, raw, **args) where raw holds every field's
+            value before post-processing. They return the new value, or
+            None to drop it.
+    """
+
+    def __init__(self, data, filters=None):
+        filters = dict(BUILTIN_FILTERS, **(filters or {}))
+        if not isinstance(data, dict) or not isinstance(data.get('fields'), dict):
+            raise SchemaError('schema must be an object with "fields"')
+        container = data.get('container')
+        if not container:
+            raise SchemaError('schema has no "container"')
+        self.container = Selector(container)
+        if not self.container.tag:
+            raise SchemaError('container selector needs a tag')
+
+        fields = data['fields']
+        missing = [name for name in RECORD_FIELDS if name not in fields]
+        if missing:
+            raise SchemaError(f'schema drops fields: {", ".join(missing)}')
+        optional = [name for name in REQUIRED_FIELDS if not fields[name].get('required')]
+        if optional:
+            raise SchemaError(f'fields must be required: {", ".join(optional)}')
+        self.fields = [Field(name, spec, filters) for name, spec in fields.items()]
+        # Required fields are looked up and post-processed first, so that
+        # nothing more is done for a container that lacks one
+        self.lookup_order = sorted(self.fields, key=lambda field: not field.required)
+        # Identifies the schema when memoizing what it extracts
+        self.digest = hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+        # Matchers by tag name (None for any tag), so each element is
+        # only tested against selectors that can match it
+        self.paths = []
+        self.each = []
+        self.index = {}
+        for field in self.fields:
+            for source in field.sources:
+                if source.kind == 'path':
+                    source.slot = len(self.paths)
+                    self.paths.append(source)
+                    for step, selectors in enumerate(source.steps):
+                        self._add('path', source.slot, step, selectors)
+                else:
+                    source.slot = len(self.each)
+                    self.each.append(source)
+                    self._add('each', source.slot, 0, source.steps[0])
+                    if source.within:
+                        self._add('within', source.slot, 0, source.within)
+        anywhere = self.index.get(None, [])
+        for tag, entries in self.index.items():
+            if tag is not None:
+                entries.extend(anywhere)
+
+    def _add(self, kind, slot, step, selectors):
+        for tag in {s.tag for s in selectors}:
+            self.index.setdefault(tag, []).append(
+                (kind, slot, step, [s for s in selectors if s.tag == tag]))
+
+    def strainer_args(self):
+        """(name, attrs) for a SoupStrainer matching containers."""
+        return self.container.tag, {name: value for name, op, value in self.container.tests if op == '='}
+
+    def extract(self, container, used=None):
+        """Return the record for a container, or None if it isn't usable.
+
+        A record isn't usable if a required field is empty or a strict
+        attribute is missing.
+
+        If a dict is passed as used, it gets the index of the source each
+        field's value came from.
+        """
+        scan = _Scan(self, container)
+        raw = {}
+        for field in self.lookup_order:
+            raw[field.name] = None
+            for n, source in enumerate(field.sources):
+                try:
+                    value = _first_value(scan, source)
+                except KeyError as err:
+                    # Missing strict attribute: only logged if the
+                    # record isn't dropped for another reason first
+                    value = err
+                if value is not None:
+                    raw[field.name] = value
+                    if used is not None:
+                        used[field.name] = n
+                    break
+            if field.required and not raw[field.name]:
+                return None
+
+        values = {}
+        for field in self.lookup_order:
+            value = raw[field.name]
+            if isinstance(value, KeyError):
+                log.debug('schema: dropped record without %s attribute %s', field.name, value)
+                return None
+            if field.flag:
+                value = bool(value and field.test.search(value))
+            elif value is not None:
+                for kind, func, arg in field.post:
+                    if kind == 'sub':
+                        value = func.sub(arg, value)
+                    else:
+                        value = func(value, raw, **arg)
+                        if value is None:
+                            break
+            if field.required and not value:
+                return None
+            values[field.name] = value
+
+        return {field.name: values[field.name] for field in self.fields}
+
+
+def _first_value(scan, source):
+    """First value a source gives, or None."""
+    candidates = scan.each[source.slot] if source.kind == 'each' else _path_match(scan, source)
+    for element, rng in candidates:
+        value = scan.value(element, rng, source)
+        if value is None:
+            continue
+        if source.regex is not None:
+            m = source.regex.search(value)
+            if not m:
+                if source.kind == 'path':
+                    return None
+                continue
+            value = m.group(1) if m.groups() else m.group(0)
+        return value
+    return None
+
+
+def _path_match(scan, source):
+    state = scan.paths[source.slot]
+    if state[0] < len(source.steps):
+        return ()
+    return ((state[2], state[3]),)
+
+
+def _alternatives(text):
+    if not isinstance(text, str):
+        raise SchemaError(f'selector must be a string: {text!r}')
+    return [Selector(part) for part in text.split(',')]
+
+
+def _compile(pattern):
+    try:
+        return re.compile(pattern)
+    except (re.error, TypeError) as e:
+        raise SchemaError(f'invalid regex {pattern!r}: {e}')
+
+
+def normalize_space(value, raw):
+    """Collapse runs of whitespace to single spaces."""
+    return ' '.join(value.split())
+
+
+def strip(value, raw):
+    """Strip leading and trailing whitespace."""
+    return value.strip()
+
+
+def nonempty(value, raw):
+    """Drop an empty value."""
+    return value or None
+
+
+def nfc(value, raw):
+    """Unicode-normalize to NFC (pages aren't normalized as a whole)."""
+    return unicodedata.normalize('NFC', value)
+
+
+BUILTIN_FILTERS = {
+    'normalize_space': normalize_space,
+    'strip': strip,
+    'nonempty': nonempty,
+    'nfc': nfc,
+}
+
+
+class _Node:
+    """Element of a container built by _StreamParser, like a bs4 Tag."""
+
+    __slots__ = ('name', 'attrs', 'contents')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.contents = []
+
+
+class _Ignored(str):
+    """Comment or other markup that separates strings but isn't text."""
+
+
+class _StreamParser(HTMLParser):
+    """Builds nodes for the containers in a page fed to it in pieces.
+
+    Nothing outside containers is kept, so memory doesn't grow with the
+    page. Tree building follows BeautifulSoup's html.parser builder with
+    a SoupStrainer for containers: an end tag closes the most recent open
+    element in the container with its name (and any opened after it) and
+    is ignored if there is none, and strings of nothing but whitespace
+    become a single space or newline. Containers in containers are found
+    too, after the one they are in.
+    """
+
+    def __init__(self, schema):
+        super().__init__(convert_charrefs=True)
+        self.container = schema.container
+        self.done = []
+        self._open = []  # nodes open in the current container, it first
+        self._found = []  # it and any containers in it
+        self._data = []  # string being read
+        self._skip = 0  # open elements whose strings aren't text
+        self._preserve = 0  # open elements keeping whitespace as is
+
+    def _end_data(self, kind=None):
+        """Add the string read so far to the open element."""
+        if not self._data:
+            return
+        data = ''.join(self._data)
+        self._data = []
+        if not self._preserve and not data.strip(ASCII_SPACES):
+            data = '\n' if '\n' in data else ' '
+        if kind is None:
+            kind = _Ignored if self._skip else str
+        contents = self._open[-1].contents
+        contents.append(data if kind is str else kind(data))
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name: value or '' for name, value in attrs}
+        if 'class' in attrs:
+            attrs['class'] = attrs['class'].split()
+
+        container = tag == self.container.tag and self.container.matches(attrs)
+        if not self._open:
+            if container:
+                node = _Node(tag, attrs)
+                self._open.append(node)
+                self._found.append(node)
+            return
+
+        self._end_data()
+        node = _Node(tag, attrs)
+        self._open[-1].contents.append(node)
+        if container:
+            self._found.append(node)
+        if tag not in VOID_ELEMENTS:
+            self._open.append(node)
+            self._skip += tag in NON_TEXT_ELEMENTS
+            self._preserve += tag in PRESERVE_WHITESPACE_ELEMENTS
+
+    def handle_endtag(self, tag):
+        stack = self._open
+        if stack:
+            # Even an end tag that closes nothing ends a string
+            self._end_data()
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i].name == tag:
+                self._close(i)
+                return
+
+    def _close(self, i):
+        self._end_data()
+        for node in self._open[max(i, 1):]:
+            self._skip -= node.name in NON_TEXT_ELEMENTS
+            self._preserve -= node.name in PRESERVE_WHITESPACE_ELEMENTS
+        if i == 0:
+            self.done.extend(self._found)
+            self._found = []
+        del self._open[i:]
+
+    def handle_data(self, data):
+        if self._open:
+            self._data.append(data)
+
+    def _ignore(self, data):
+        if self._open:
+            self._end_data()
+            self._data.append(data)
+            self._end_data(_Ignored)
+
+    handle_comment = handle_decl = handle_pi = _ignore
+
+    def unknown_decl(self, data):
+        if not self._open:
+            return
+        if data.startswith('CDATA['):
+            # Text even in a script or template, as in a tree
+            self._end_data()
+            self._data.append(data[6:])
+            self._end_data(str)
+        else:
+            self._ignore(data)
+
+    def close(self):
+        super().close()
+        if self._open:
+            # Unclosed at the end of the page, as in a tree
+            self._close(0)
+
+
+def iter_containers(schema, chunks):
+    """Yield the containers in a page as each one closes.
+
+    chunks is an iterable of str, e.g. a response body as it is decoded.
+    The containers can be passed to Schema.extract(). Stop iterating to
+    stop reading chunks.
+    """
+    parser = _StreamParser(schema)
+    for chunk in chunks:
+        parser.feed(chunk)
+        if parser.done:
+            yield from parser.done
+            parser.done = []
+
+    parser.close()
+    yield from parser.done
+
+
+class Memo:
+    """Bounded on-disk memo of extracted records, keyed by a hash of their markup.
+
+    Each entry is a JSON file in dirpath named by its key, so separate
+    processes share it. Reading an entry marks it as recently used, and
+    prune() deletes the least recently used beyond max_entries.
+
+    Args:
+        dirpath (str): Directory to keep entries in.
+        max_entries (int): Number of entries to keep.
+    """
+
+    def __init__(self, dirpath, max_entries):
+        self.dirpath = dirpath
+        self.max_entries = max_entries
+        self.added = 0
+
+    @staticmethod
+    def key(salt, markup):
+        """Key for markup (bytes); salt is everything else its records depend on."""
+        return hashlib.sha1(salt.encode('utf-8') + b'\0' + markup).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dirpath, key + '.json')
+
+    def get(self, key, default=None):
+        """Return the value memoized for key, or default if there is none."""
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return default
+        return value
+
+    def set(self, key, value):
+        """Memoize a JSON-serializable value for key, if it can be written."""
+        try:
+            os.makedirs(self.dirpath, exist_ok=True)
+            with atomic_writer(self._path(key), 'w') as f:
+                json.dump(value, f)
+        except OSError:
+            return
+        self.added += 1
+
+    def prune(self):
+        """Delete the least recently used entries beyond max_entries."""
+        if not self.added:
+            return
+        try:
+            entries = list(os.scandir(self.dirpath))
+        except OSError:
+            return
+        excess = len(entries) - self.max_entries
+        if excess <= 0:
+            return
+        # Another process may be pruning too
+        def used(entry):
+            try:
+                return entry.stat().st_mtime
+            except OSError:
+                return 0
+        for entry in sorted(entries, key=used)[:excess]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def load(path, filters=None):
+    """Return the compiled schema in a JSON file, compiling it only if it changed.
+
+    Raises SchemaError if the schema is invalid, and OSError if the file
+    can't be read.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _compiled.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, encoding='utf-8') as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise SchemaError(f'{path}: {e}')
+    schema = Schema(data, filters)
+    _compiled[path] = (mtime, schema)
+    return schema
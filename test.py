@@ -1,9 +1,23 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 
-from workflow import web
+from workflow import web, proxy
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+from bs4.builder import builder_registry
+import argparse
+import asyncio
+import json
+import os
+import socket
 import sys
+import tempfile
+import time
+import tracemalloc
+import unicodedata
+import amazon
 from urllib.parse import quote
 
 HEADERS = {
@@ -24,44 +38,338 @@ def test_search(query):
     with open('sample.html', 'w', encoding='utf-8') as f:
         f.write(html)
     
+    product_schema = amazon.load_schema()
     soup = BeautifulSoup(html, 'html.parser')
-    products = soup.find_all('div', {'data-component-type': 's-search-result'})
+    products = soup.find_all(*product_schema.strainer_args())
     print(f"Found {len(products)} products")
     
     for product in products[:3]:  # Look at first 3 products
         print("\nAnalyzing product structure:")
         
-        # Method 1: h2 in a-section
-        title_section = product.find('div', {'class': 'a-section'})
-        if title_section:
-            h2 = title_section.find('h2')
-            if h2:
-                link = h2.find('a')
-                if link:
-                    print("Method 1 found:")
-                    print(f"Title: {link.get_text().strip()}")
-                    print(f"URL: {link.get('href')}")
-        
-        # Method 2: span with a-text-normal
-        title_span = product.find('span', {'class': 'a-text-normal'})
-        if title_span:
-            parent_link = title_span.find_parent('a')
-            if parent_link:
-                print("Method 2 found:")
-                print(f"Title: {title_span.get_text().strip()}")
-                print(f"URL: {parent_link.get('href')}")
-        
-        # Method 3: Direct product link
-        product_link = product.find('a', {'class': 'a-link-normal s-underline-text s-underline-link-text s-link-style a-text-normal'})
-        if product_link:
-            print("Method 3 found:")
-            print(f"Title: {product_link.get_text().strip()}")
-            print(f"URL: {product_link.get('href')}")
+        # Which schema source each field came from
+        used = {}
+        record = product_schema.extract(product, used)
+        if record is None:
+            print("Dropped: missing a required field")
+        for field in product_schema.fields:
+            if field.name in used:
+                print(f"{field.name} (source {used[field.name] + 1} of {len(field.sources)}): {record and record[field.name]!r}")
+            else:
+                print(f"{field.name}: not found")
         
         # Print raw HTML structure
         print("\nRaw HTML structure:")
         print(product.prettify()[:500] + "...")  # First 500 chars
 
+def installed_parsers():
+    return [name for name in amazon.PARSER_BACKENDS if builder_registry.lookup(name)]
+
+def read_page(path):
+    """Text of a saved page, as Response.text would give it."""
+    with open(path, encoding='utf-8') as f:
+        return unicodedata.normalize('NFC', f.read())
+
+def stream_page(path):
+    """Records from a saved page fed to the stream parser as it would be downloaded."""
+    def chunks():
+        with open(path, 'rb') as f:
+            while chunk := f.read(amazon.STREAM_CHUNK_SIZE):
+                yield chunk
+    return amazon.parse_search_stream(chunks(), 'utf-8')
+
+def test_parity(paths):
+    """Check every parser backend extracts the same records from saved pages."""
+    parsers = installed_parsers()
+    ok = True
+    for path in paths:
+        html = read_page(path)
+        expected = amazon.parse_search_results(html, parsers[0])
+        for name in parsers[1:] + [amazon.STREAM_PARSER]:
+            if name == amazon.STREAM_PARSER:
+                records = stream_page(path)
+            else:
+                records = amazon.parse_search_results(html, name)
+            if records == expected:
+                print(f"{path}: {name} OK ({len(records)} records)")
+                continue
+            ok = False
+            print(f"{path}: {name} DIFFERS from {parsers[0]} ({len(records)} vs {len(expected)} records)")
+            for a, b in zip(expected, records):
+                if a != b:
+                    print(f"  {parsers[0]}: {a}\n  {name}: {b}")
+                    break
+    return ok
+
+def parse_full_tree(html, parser):
+    """Extract records the old way, from a tree of the whole page."""
+    product_schema = amazon.load_schema()
+    soup = BeautifulSoup(html, parser)
+    products = soup.find_all(*product_schema.strainer_args())
+    return list(amazon.take_usable(product_schema.extract(product) for product in products))
+
+def measure(func, repeat):
+    """Return (seconds per call, peak bytes allocated) of func()."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+def benchmark(paths, repeat=10):
+    """Print parse time and peak memory per page for each parser backend."""
+    for path in paths:
+        html = read_page(path)
+        with open(path, 'rb') as f:
+            body = f.read()
+        start, end = amazon.results_region(body)
+        region = body[start:end]
+        print(f"{path}: results region is {end - start} of {len(body)} bytes")
+        for name in installed_parsers():
+            for label, func, page in (('full tree', parse_full_tree, html),
+                                      ('results only', amazon.parse_search_results, html),
+                                      ('region bytes', lambda page, name: amazon.parse_search_results(page, name, 'utf-8'), region)):
+                elapsed, peak = measure(lambda: func(page, name), repeat)
+                print(f"{path}: {name:12} {label:13} {elapsed * 1000:8.1f}ms {peak / 1024 / 1024:6.1f}MB peak")
+        elapsed, peak = measure(lambda: stream_page(path), repeat)
+        print(f"{path}: {amazon.STREAM_PARSER:12} {'from bytes':13} {elapsed * 1000:8.1f}ms {peak / 1024 / 1024:6.1f}MB peak")
+
+class StandInUpstream(BaseHTTPRequestHandler):
+    """Slow upstream with ETags, for checking what the proxy shares."""
+    
+    protocol_version = 'HTTP/1.1'
+    delay = 0.3  # seconds before answering, so requests overlap
+    
+    def do_GET(self):
+        self.server.requests[self.path] = self.server.requests.get(self.path, 0) + 1
+        time.sleep(self.delay)
+        if self.path == '/missing':
+            self.send_response(404)
+            body = b''
+        elif self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            body = b''
+        else:
+            self.send_response(200)
+            body = f"body of {self.path}".encode()
+        self.send_header('ETag', '"v1"')
+        self.send_header('Cache-Control', 'max-age=60')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+class StandInServer(BaseHTTPRequestHandler):
+    """Local server for checking workflow.web; the path says what to answer.
+
+    /error/CODE answers CODE with a short body.
+    /ok/NAME answers 200 with NAME as body and ETag.
+    /auth answers 200 with the Authorization header as body.
+    /redirect?URL answers 302 to URL.
+    """
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def do_GET(self):
+        parts = self.path.split('/')
+        if parts[1] == 'error':
+            self.send_response(int(parts[2]))
+            body = b'error page'
+        elif parts[1] == 'auth':
+            self.send_response(200)
+            body = self.headers.get('Authorization', '').encode()
+        elif parts[1].startswith('redirect?'):
+            self.send_response(302)
+            self.send_header('Location', self.path.split('?', 1)[1])
+            body = b''
+        elif parts[1] == 'ok':
+            self.send_response(200)
+            self.send_header('ETag', '"%s"' % parts[2])
+            body = parts[2].encode()
+        else:
+            self.send_response(404)
+            body = b''
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+def serve(server):
+    """Run server in a thread and return its base URL."""
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://{server.server_address[0]}:{server.server_address[1]}"
+
+def check(name, ok, detail):
+    """Print and return the outcome of a check."""
+    print(f"{name}: {'OK' if ok else 'FAILED'} ({detail})")
+    return ok
+
+def test_web():
+    """Check workflow.web against a local stand-in server."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInServer)
+    base = serve(server)
+    ok = True
+    try:
+        # Error responses give their connection back to the pool
+        before = web.pool_stats()
+        for _ in range(5):
+            web.get(base + '/error/503')
+        after = web.pool_stats()
+        opened = after['connections'] - before['connections']
+        ok &= check('error reuse', opened == 1, f"{opened} connections for 5 errors")
+
+        # Credentials are sent to the host asked for, not where it redirects to
+        auth = ('user', 'secret')
+        direct = web.get(base + '/auth', auth=auth).content
+        other = base.replace('127.0.0.1', 'localhost')
+        redirected = web.get(base + '/redirect?' + other + '/auth', auth=auth).content
+        ok &= check('redirect auth', direct.startswith(b'Basic ') and redirected == b'',
+                    f"{direct!r} direct, {redirected!r} after redirect")
+
+        # DNS caches sharing a file keep each other's entries, and forgetting sticks
+        with tempfile.TemporaryDirectory() as dirpath:
+            path = os.path.join(dirpath, 'dns.json')
+            first, second = web.DNSCache(path), web.DNSCache(path)
+            second.get('127.0.0.1', 80)  # loaded before the first one writes
+            first.resolve('localhost', 80)
+            second.resolve('127.0.0.1', 80)
+            shared = [host for host in ('localhost', '127.0.0.1') if web.DNSCache(path).get(host, 80)]
+            first.forget('127.0.0.1', 80)
+            kept = [host for host in ('localhost', '127.0.0.1') if web.DNSCache(path).get(host, 80)]
+            ok &= check('dns sharing', shared == ['localhost', '127.0.0.1'] and kept == ['localhost'],
+                        f"{shared} shared, {kept} kept after forgetting")
+
+        # When cached addresses don't answer, the fresh ones only get the rest of the timeout
+        with tempfile.TemporaryDirectory() as dirpath, socket.socket() as silent:
+            # A listener with a full backlog never completes a connection
+            silent.bind(('127.0.0.1', 0))
+            silent.listen(0)
+            backlog = socket.create_connection(silent.getsockname())
+            path = os.path.join(dirpath, 'dns.json')
+            port = silent.getsockname()[1]
+            with open(path, 'w') as f:
+                json.dump({f'localhost:{port}': {'addrs': [[socket.AF_INET, ['127.0.0.1', port]]],
+                                                  'expires': time.time() + 60, 'cost': 0}}, f)
+            start = time.monotonic()
+            try:
+                web.DNSCache(path).create_connection(('localhost', port), timeout=0.5).close()
+            except OSError:
+                pass
+            elapsed = time.monotonic() - start
+            backlog.close()
+            ok &= check('dns connect timeout', elapsed < 0.75, f"{elapsed:.2f}s for a 0.5s timeout")
+
+        # Bodies can be saved from coroutines, on workers that don't hold up exit
+        async def save(path):
+            r = await web.aget(base + '/ok/saved', stream=True)
+            await r.asave_to_path(path)
+        with tempfile.TemporaryDirectory() as dirpath:
+            path = os.path.join(dirpath, 'saved')
+            asyncio.run(save(path))
+            with open(path, 'rb') as f:
+                saved = f.read()
+        workers = [t for t in threading.enumerate() if t.name.startswith('web_')]
+        ok &= check('async save', saved == b'saved' and workers and all(t.daemon for t in workers),
+                    f"{saved!r} saved, {sum(t.daemon for t in workers)} of {len(workers)} workers daemon")
+
+        # The HTTP cache keeps its most recently used entries when pruned
+        with tempfile.TemporaryDirectory() as dirpath:
+            cache = web.HTTPCache(dirpath, max_entries=3)
+            for name in 'abcde':
+                web.get(base + '/ok/' + name, cache=cache).content
+                time.sleep(0.01)
+            web.get(base + '/ok/a', cache=cache).content
+            cache.prune()
+            kept = [name for name in 'abcde' if cache.load(base + '/ok/' + name)]
+            ok &= check('cache pruning', kept == ['a', 'd', 'e'], f"kept {kept}")
+    finally:
+        server.shutdown()
+    return ok
+
+def test_proxy():
+    """Check the proxy coalesces, caches and passes through requests to a stand-in upstream."""
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), StandInUpstream)
+    upstream.requests = {}
+    server = proxy.ProxyServer()
+    base = serve(upstream)
+    serve(server)
+    web.transport = web.ProxyTransport(server.server_address)
+    
+    def get(path, headers=None, after=0):
+        time.sleep(after)
+        r = web.get(base + path, headers=headers)
+        # Error responses have no body to read
+        return r.status_code, r.content if r.error is None else b'', r.headers.get('X-Cache')
+    
+    ok = True
+    try:
+        with ThreadPoolExecutor(8) as pool:
+            # Identical requests in flight together share one upstream request
+            results = list(pool.map(lambda _: get('/shared'), range(5)))
+            ok &= check('coalescing', all(r[:2] == (200, b'body of /shared') for r in results)
+                        and upstream.requests['/shared'] == 1,
+                        f"{upstream.requests['/shared']} upstream for 5, {sorted(r[2] for r in results)}")
+            r = get('/shared')
+            ok &= check('caching', r[2] == 'HIT' and upstream.requests['/shared'] == 1, r[2])
+            
+            # A conditional request's 304 is only for the client that sent it
+            conditional = pool.submit(get, '/conditional', {'If-None-Match': '"v1"'})
+            plain = [pool.submit(get, '/conditional', after=0.1) for _ in range(3)]
+            status = conditional.result()[0]
+            results = [f.result() for f in plain]
+            ok &= check('conditional', status == 304
+                        and all(r[:2] == (200, b'body of /conditional') for r in results),
+                        f"{status} for the conditional request, {[r[0] for r in results]} for plain ones")
+            
+            # A range request isn't cached for the full body
+            get('/ranged', {'Range': 'bytes=0-3'})
+            r = get('/ranged')
+            ok &= check('range', r[2] == 'MISS' and upstream.requests['/ranged'] == 2, r[2])
+            
+            # Errors aren't shared: each follower asks for itself
+            results = list(pool.map(lambda _: get('/missing'), range(3)))
+            ok &= check('errors', all(r[0] == 404 for r in results) and upstream.requests['/missing'] == 3,
+                        f"{upstream.requests['/missing']} upstream for 3")
+    finally:
+        web.transport = None
+        server.shutdown()
+        upstream.shutdown()
+    print(server.stats())
+    return ok
+
 if __name__ == '__main__':
-    query = sys.argv[1] if len(sys.argv) > 1 else "samsung tv"
-    test_search(query) 
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('query', nargs='?', default="samsung tv")
+    parser.add_argument('--record', metavar='DIR', help="record responses to DIR")
+    parser.add_argument('--replay', metavar='DIR', help="replay responses from DIR, offline")
+    parser.add_argument('--latency', type=float, default=0, help="seconds to add to each replayed response")
+    parser.add_argument('--parity', nargs='+', metavar='HTML', help="compare parser backends on saved pages")
+    parser.add_argument('--bench', nargs='+', metavar='HTML', help="time parser backends on saved pages")
+    parser.add_argument('--repeat', type=int, default=10, help="parses per page when benchmarking")
+    parser.add_argument('--proxy', action='store_true', help="check the web proxy against a local stand-in upstream")
+    parser.add_argument('--web', action='store_true', help="check workflow.web against a local stand-in server")
+    args = parser.parse_args()
+
+    if args.web:
+        sys.exit(0 if test_web() else 1)
+    if args.proxy:
+        sys.exit(0 if test_proxy() else 1)
+    if args.parity:
+        sys.exit(0 if test_parity(args.parity) else 1)
+    if args.bench:
+        benchmark(args.bench, args.repeat)
+        sys.exit(0)
+
+    if args.replay:
+        web.transport = web.ReplayTransport(args.replay, args.latency)
+    elif args.record:
+        web.transport = web.RecordingTransport(args.record)
+
+    test_search(args.query)
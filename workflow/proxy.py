@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+
+"""Local caching HTTP proxy shared by a workflow's processes.
+
+Alfred starts a new process for every keystroke, so connections, DNS
+resolutions and TLS sessions die with each one. This module runs a
+small proxy on localhost in a background process (via
+:mod:`workflow.background`) that outlives them:
+
+- upstream connections are pooled and kept warm,
+- identical requests that arrive while one is in flight share its
+  response (unless it isn't a ``200``),
+- cacheable ``GET`` responses are served from memory.
+
+Conditional and range requests always go upstream, as their responses
+depend on what the client already has.
+
+Clients send it the full URL (including ``https://`` URLs) over plain
+HTTP; :class:`workflow.web.ProxyTransport` does this for
+:mod:`workflow.web`. Bodies are passed through still compressed. The
+proxy exits after :data:`IDLE_TIMEOUT` seconds without requests.
+
+>>> from workflow import proxy, web
+>>> address = proxy.get_address(wf)
+>>> if address:
+...     web.transport = web.ProxyTransport(address)
+... else:
+...     proxy.start(wf, warm=['https://www.example.com/'])
+
+"""
+
+import argparse
+import collections
+import http.server
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from workflow import Workflow, web
+from workflow.background import is_running, run_in_background
+from workflow.util import atomic_writer
+
+__all__ = ["ProxyServer", "get_address", "start"]
+
+wf = Workflow()
+log = logging.getLogger(__name__)
+
+# Name of the background job
+JOB_NAME = "web-proxy"
+
+# Cache file the running proxy writes its address to
+STATE_FILE = "proxy.json"
+
+# Seconds without requests after which the proxy exits
+IDLE_TIMEOUT = 300
+
+# Seconds between checks for idleness and cold connections
+HOUSEKEEPING_INTERVAL = 10
+
+# Seconds to wait for upstream servers
+UPSTREAM_TIMEOUT = (5, 15)
+
+# Seconds cacheable responses without ``max-age`` are kept, and the most
+# any response is kept
+CACHE_TTL = 60
+MAX_CACHE_TTL = 3600
+
+# Bytes of response bodies kept in memory
+MAX_CACHE_BYTES = 32 * 1024 * 1024
+
+# Request headers that make the response depend on what the client
+# already has, so it can't be shared with or cached for other clients
+CONDITIONAL = {
+    "if-none-match",
+    "if-modified-since",
+    "if-match",
+    "if-unmodified-since",
+    "if-range",
+    "range",
+}
+
+# Headers that apply to a single connection and aren't forwarded
+HOP_BY_HOP = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+}
+
+_max_age = re.compile(r"max-age=(\d+)").search
+
+
+class Entry:
+    """A complete upstream response.
+
+    Attributes:
+        status (int): HTTP status code.
+        reason (str): HTTP reason phrase.
+        headers (list): ``(name, value)`` end-to-end headers.
+        body (bytes): Body as received (i.e. still content-encoded).
+
+    """
+
+    def __init__(self, status, reason, headers, body):
+        """Create new :class:`Entry`."""
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def ttl(self):
+        """Return seconds this response may be cached for (0 if not)."""
+        if self.status != 200:
+            return 0
+
+        headers = {k.lower(): v for k, v in self.headers}
+        cache_control = headers.get("cache-control", "").lower()
+        if any(d in cache_control for d in ("no-store", "no-cache", "private")):
+            return 0
+
+        if "set-cookie" in headers or headers.get("vary", "").strip() == "*":
+            return 0
+
+        m = _max_age(cache_control)
+        if m:
+            return min(int(m.group(1)), MAX_CACHE_TTL)
+
+        return CACHE_TTL
+
+
+class ResponseCache:
+    """In-memory LRU cache of :class:`Entry` objects, bounded by body size.
+
+    Attributes:
+        hits (int): Requests answered from the cache.
+        misses (int): Cacheable requests that weren't.
+
+    """
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        """Create new :class:`ResponseCache`."""
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return unexpired :class:`Entry` for ``key`` or ``None``."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[1] < time.time():
+                self._remove(key)
+                item = None
+
+            if item is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, entry):
+        """Cache ``entry`` under ``key`` if it is cacheable."""
+        ttl = entry.ttl()
+        if not ttl or len(entry.body) > self.max_bytes:
+            return
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (entry, time.time() + ttl)
+            self.size += len(entry.body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self.size -= len(item[0].body)
+
+
+class _Call:
+    """An upstream request that other requests may wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+        self.error = None
+
+
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    """Answer requests for absolute URLs via :meth:`ProxyServer.fetch`."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Proxy the request."""
+        if not self.path.startswith(("http://", "https://")):
+            self.send_error(400, "Absolute URL required")
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        headers = {
+            k: v for k, v in self.headers.items() if k.lower() not in HOP_BY_HOP
+        }
+
+        try:
+            entry, source = self.server.fetch(self.command, self.path, headers, body)
+        except web.Timeout as err:
+            self.send_error(504, str(err))
+            return
+        except (OSError, urllib.error.URLError) as err:
+            self.send_error(502, str(err))
+            return
+
+        self.log_request(entry.status)
+        self.send_response_only(entry.status, entry.reason)
+        for key, value in entry.headers:
+            self.send_header(key, value)
+
+        # Upstream's HEAD responses have no body, but may have a length
+        if self.command != "HEAD":
+            self.send_header("Content-Length", str(len(entry.body)))
+
+        self.send_header("X-Cache", source)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(entry.body)
+
+    do_HEAD = do_POST = do_PUT = do_DELETE = do_GET
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        log.debug("proxy: " + format, *args)
+
+
+class ProxyServer(http.server.ThreadingHTTPServer):
+    """Caching, request-coalescing HTTP proxy.
+
+    Run :meth:`serve_forever` in a thread to use it in-process, e.g.
+    against a local test server.
+
+    Args:
+        address (tuple): ``(host, port)`` to listen on. Use port ``0``
+            for any free port.
+
+    Attributes:
+        cache (ResponseCache): Cached responses.
+        last_request (float): Time of the most recent request.
+        requests (int): Requests received.
+        upstream (int): Requests sent to upstream servers.
+        coalesced (int): Requests answered by another's upstream request.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        """Create new :class:`ProxyServer`."""
+        super().__init__(address, ProxyHandler)
+        self.cache = ResponseCache()
+        self.last_request = time.time()
+        self.requests = 0
+        self.upstream = 0
+        self.coalesced = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, method, url, headers, body=None):
+        """Return response to a request and where it came from.
+
+        :returns: ``(entry, source)`` where ``source`` is ``HIT``,
+            ``COALESCED`` or ``MISS``
+        :rtype: tuple
+
+        """
+        with self._lock:
+            self.requests += 1
+            self.last_request = time.time()
+
+        lowered = {k.lower() for k in headers}
+        if (
+            method != "GET"
+            or body
+            or lowered & {"authorization", "cookie"}
+            or lowered & CONDITIONAL
+        ):
+            return self._upstream(method, url, headers, body), "MISS"
+
+        key = (url, headers.get("Accept-Encoding", ""))
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry, "HIT"
+
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+
+            # Only a complete response is worth sharing; anything else,
+            # the follower asks for itself
+            if call.entry.status != 200:
+                return self._upstream(method, url, headers, body), "MISS"
+
+            with self._lock:
+                self.coalesced += 1
+
+            return call.entry, "COALESCED"
+
+        try:
+            call.entry = self._upstream(method, url, headers, body)
+            self.cache.put(key, call.entry)
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+            call.done.set()
+
+        return call.entry, "MISS"
+
+    def _upstream(self, method, url, headers, body):
+        """Send request upstream and return response as :class:`Entry`."""
+        with self._lock:
+            self.upstream += 1
+
+        req = web.Request(url, body, headers, method=method, timeout=UPSTREAM_TIMEOUT)
+        # Never back through a proxy transport
+        req.transport = None
+        # Redirects are the client's business
+        opener = web._get_opener(False)  # pylint: disable=protected-access
+        try:
+            r = opener.open(req, timeout=req.timeout)
+            status = r.status
+        except urllib.error.HTTPError as err:
+            r = err
+            status = err.code
+
+        with r:
+            entry = Entry(
+                status,
+                r.reason,
+                [(k, v) for k, v in r.headers.items() if k.lower() not in HOP_BY_HOP],
+                r.read(),
+            )
+
+        log.debug("proxy: %s %s -> %d, %d bytes", method, url, status, len(entry.body))
+        return entry
+
+    def stats(self):
+        """Return request, upstream, coalesced and cache hit counts."""
+        return {
+            "requests": self.requests,
+            "upstream": self.upstream,
+            "coalesced": self.coalesced,
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+        }
+
+
+def serve(server, idle_timeout=IDLE_TIMEOUT, warm=()):
+    """Run ``server`` until it hasn't had a request for ``idle_timeout`` seconds.
+
+    :param server: proxy to run
+    :type server: :class:`ProxyServer`
+    :param idle_timeout: seconds without requests before exiting
+    :type idle_timeout: float
+    :param warm: URLs of hosts to keep a connection open to
+    :type warm: list
+
+    """
+    # Keep upstream connections for as long as the proxy runs
+    web.pool.idle_timeout = idle_timeout
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        while time.time() - server.last_request < idle_timeout:
+            for url in warm:
+                try:
+                    web.preconnect(url)
+                except (OSError, web.Timeout) as err:
+                    log.debug("proxy: couldn't connect to %s: %s", url, err)
+
+            time.sleep(min(HOUSEKEEPING_INTERVAL, idle_timeout))
+    finally:
+        server.shutdown()
+        server.server_close()
+        web.pool.clear()
+
+    log.debug("proxy: idle for %ds, exiting (%r)", idle_timeout, server.stats())
+
+
+def get_address(wf):  # pylint: disable=redefined-outer-name
+    """Return ``(host, port)`` of the running proxy or ``None``."""
+    if not is_running(JOB_NAME):
+        return None
+
+    try:
+        with open(wf.cachefile(STATE_FILE), encoding="utf-8") as fp:
+            state = json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+    return (state["host"], state["port"])
+
+
+def start(wf, idle_timeout=IDLE_TIMEOUT, warm=()):  # pylint: disable=redefined-outer-name
+    """Start the proxy in the background unless it is already running.
+
+    :param idle_timeout: seconds without requests before it exits
+    :type idle_timeout: float
+    :param warm: URLs of hosts to keep a connection open to
+    :type warm: list
+
+    """
+    cmd = [sys.executable, "-m", "workflow.proxy", "--idle", str(idle_timeout)]
+    run_in_background(JOB_NAME, cmd + list(warm))
+
+
+def main(wf):  # pragma: no cover  # pylint: disable=redefined-outer-name
+    """Run the proxy until it idles out."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--idle", type=float, default=IDLE_TIMEOUT)
+    parser.add_argument("warm", nargs="*")
+    args = parser.parse_args(wf.args)
+
+    web.dns_cache = web.DNSCache(wf.cachefile("dns.json"))
+    server = ProxyServer()
+    host, port = server.server_address[:2]
+    statefile = wf.cachefile(STATE_FILE)
+    with atomic_writer(statefile, "w") as fp:
+        json.dump({"pid": os.getpid(), "host": host, "port": port}, fp)
+
+    log.debug("proxy: listening on %s:%d", host, port)
+    try:
+        serve(server, args.idle, args.warm)
+    finally:
+        os.unlink(statefile)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    wf.run(main)
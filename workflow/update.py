@@ -24,6 +24,8 @@ from . import Workflow, web
 
 
 RELEASES_BASE = "https://api.github.com/repos/{}/releases"
+# Largest workflow file that will be downloaded
+MAX_DOWNLOAD_SIZE = 100 * 1024 * 1024
 match_workflow = re.compile(r"\.alfred(\d+)?workflow$").search
 
 wf = Workflow()
@@ -387,7 +389,7 @@ def retrieve_download(dl):
     path = os.path.join(tempfile.gettempdir(), dl.filename)
     wf.logger.debug("downloading update from %r to %r ...", dl.url, path)
 
-    r = web.get(dl.url)
+    r = web.get(dl.url, stream=True, max_bytes=MAX_DOWNLOAD_SIZE)
     r.raise_for_status()
     r.save_to_path(path)
 
@@ -423,7 +425,7 @@ def get_downloads(repo):
 
     def _fetch():
         wf.logger.info("retrieving releases for %r ...", repo)
-        r = web.get(url)
+        r = web.get(url, cache=web.HTTPCache(wf.cachefile("http")))
         r.raise_for_status()
         return r.content
 
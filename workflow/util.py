@@ -355,6 +355,8 @@ def atomic_writer(fpath, mode):
     with open(temppath, mode) as f:  # pylint: disable=unspecified-encoding
         try:
             yield f
+            # Readers mustn't see the file before its contents
+            f.flush()
             os.rename(temppath, fpath)
         finally:
             try:
@@ -1,19 +1,50 @@
 """Lightweight HTTP library with a requests-like interface."""
 
+import asyncio
+import base64
 import codecs
+import concurrent.futures
+import copy
+import fcntl
+import functools
+import hashlib
+import http.client
+import io
 import json
+import logging
 import mimetypes
 import os
+import queue
 import re
 import secrets
+import shutil
 import socket
+import ssl
 import string
+import threading
+import time
 import unicodedata
 import urllib.request
 import urllib.parse
 import urllib.error
+import urllib.response
 import zlib
 
+from .util import LockFile, atomic_writer
+
+# Optional decompressors for "br" and "zstd" content codings
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
 # pylint: disable=consider-using-with
 __version__ = open(
     os.path.join(os.path.dirname(__file__), "version"), encoding="utf-8"
@@ -24,6 +55,35 @@ USER_AGENT = f"Alpynist/{__version__}"
 # Valid characters for multipart form data boundaries
 BOUNDARY_CHARS = string.digits + string.ascii_letters
 
+# Idle keep-alive connections kept per (scheme, host, port)
+POOL_MAXSIZE = 8
+# Seconds an idle keep-alive connection is kept before being discarded
+POOL_IDLE_TIMEOUT = 60
+
+# Content codings advertised in Accept-Encoding
+ACCEPT_ENCODINGS = ["gzip", "deflate"]
+if brotli is not None:  # pragma: no cover
+    ACCEPT_ENCODINGS.append("br")
+if zstandard is not None:  # pragma: no cover
+    ACCEPT_ENCODINGS.append("zstd")
+
+# Bytes read from the socket at a time by `Response.content`
+CONTENT_CHUNK_SIZE = 65536
+
+# Most bytes of an error response's body read so that its connection can
+# go back to the pool; it is closed instead if there are more
+MAX_ERROR_BODY = 65536
+
+# Responses kept by `HTTPCache` when it is pruned
+HTTP_CACHE_MAX_ENTRIES = 1000
+
+# Seconds a resolved address is cached by `DNSCache` (the stdlib resolver
+# doesn't expose record TTLs)
+DNS_TTL = 300
+
+# Worker threads used by the asyncio interface
+ASYNC_MAX_WORKERS = 16
+
 # HTTP response codes
 RESPONSES = {
     100: "Continue",
@@ -69,6 +129,293 @@ RESPONSES = {
 }
 
 
+class Timeout(TimeoutError):
+    """Raised if a request times out."""
+
+
+class RateLimited(Timeout):
+    """Raised if a :class:`RateLimiter` can't grant a request in time."""
+
+
+class ConnectTimeout(Timeout):
+    """Raised if a connection (incl. TLS handshake) isn't established in time."""
+
+
+class ReadTimeout(Timeout):
+    """Raised if the server doesn't send any data for too long."""
+
+
+class NotRecorded(urllib.error.URLError):
+    """Raised by :class:`ReplayTransport` for requests without a recording."""
+
+
+class ResponseTooLarge(Exception):
+    """Raised if a response body exceeds the ``max_bytes`` of its request.
+
+    Attributes:
+        max_bytes (int): The limit that was exceeded.
+
+    """
+
+    def __init__(self, message, max_bytes):
+        """Create new :class:`ResponseTooLarge`."""
+        super().__init__(message)
+        self.max_bytes = max_bytes
+
+
+class CircuitOpenError(Exception):
+    """Raised by :meth:`CircuitBreaker.check` while requests are suspended.
+
+    Attributes:
+        retry_after (float): Seconds until a request will be let through.
+
+    """
+
+    def __init__(self, message, retry_after):
+        """Create new :class:`CircuitOpenError`."""
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _split_timeout(timeout):
+    """Return ``(connect, read)`` timeouts from ``timeout``.
+
+    :param timeout: seconds for both, or ``(connect, read)`` tuple
+    :type timeout: float or tuple
+    :rtype: 2-tuple
+
+    """
+    if isinstance(timeout, (tuple, list)):
+        return tuple(timeout)
+
+    return (timeout, timeout)
+
+
+class Deadline:
+    """Overall time budget shared by several requests.
+
+    >>> deadline = Deadline(0.8)
+    >>> r = get(url, timeout=deadline.timeout((3, 5)))
+
+    Args:
+        budget (float): Seconds from now until the deadline.
+
+    Attributes:
+        expires (float): Deadline as a :func:`time.monotonic` value.
+
+    """
+
+    def __init__(self, budget):
+        """Create new :class:`Deadline`."""
+        self.expires = time.monotonic() + budget
+
+    def remaining(self):
+        """Seconds left until the deadline (never negative)."""
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self):
+        """``True`` if the deadline has passed."""
+        return self.remaining() <= 0
+
+    def timeout(self, timeout):
+        """Return ``timeout`` capped at the time remaining.
+
+        :param timeout: seconds, or ``(connect, read)`` tuple
+        :type timeout: float or tuple
+        :returns: ``(connect, read)`` timeouts
+        :rtype: 2-tuple
+
+        """
+        remaining = max(self.remaining(), 0.001)
+        return tuple(
+            remaining if t is None else min(t, remaining)
+            for t in _split_timeout(timeout)
+        )
+
+
+class CircuitBreaker:
+    """Circuit breaker whose state is shared between processes via a file.
+
+    After ``threshold`` consecutive failures the circuit opens and
+    :meth:`check` raises :class:`CircuitOpenError` for ``cooldown``
+    seconds. Then it is half-open: one caller is let through as a probe,
+    and its success closes the circuit again, while a failure re-opens
+    it.
+
+    >>> breaker = CircuitBreaker(wf.cachefile('breaker.json'))
+    >>> breaker.check()
+    >>> try:
+    ...     r = get(url)
+    ...     r.raise_for_status()
+    ... except Exception:
+    ...     breaker.record_failure()
+    ...     raise
+    >>> breaker.record_success()
+
+    Args:
+        path (str): File to store the breaker's state in.
+        threshold (int): Consecutive failures that open the circuit.
+        cooldown (float): Seconds the circuit stays open.
+
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, path, threshold=3, cooldown=60):
+        """Create new :class:`CircuitBreaker`."""
+        self.path = path
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {"state": self.CLOSED, "failures": 0, "since": 0}
+
+    def _save(self, state):
+        with atomic_writer(self.path, "w") as fp:
+            json.dump(state, fp)
+
+    @property
+    def state(self):
+        """Current state: ``closed``, ``open`` or ``half-open``."""
+        return self._load()["state"]
+
+    def check(self):
+        """Raise :class:`CircuitOpenError` if no request should be sent now."""
+        # Fast path: no lock needed to find the circuit closed
+        if self._load()["state"] == self.CLOSED:
+            return
+
+        with LockFile(self.path):
+            state = self._load()
+            if state["state"] == self.CLOSED:
+                return
+
+            # While open, or while another caller's probe is in flight
+            wait = state["since"] + self.cooldown - time.time()
+            if wait > 0:
+                raise CircuitOpenError(
+                    f"circuit {state['state']}, retry in {wait:.0f}s", wait
+                )
+
+            # Let this caller probe
+            state.update(state=self.HALF_OPEN, since=time.time())
+            self._save(state)
+
+    def record_success(self):
+        """Close the circuit."""
+        state = self._load()
+        if state["state"] == self.CLOSED and not state["failures"]:
+            return
+
+        with LockFile(self.path):
+            self._save({"state": self.CLOSED, "failures": 0, "since": time.time()})
+
+    def record_failure(self):
+        """Count a failure, opening the circuit if there are too many."""
+        with LockFile(self.path):
+            state = self._load()
+            state["failures"] += 1
+            if (
+                state["state"] == self.HALF_OPEN
+                or state["failures"] >= self.threshold
+            ):
+                state.update(state=self.OPEN, since=time.time())
+
+            self._save(state)
+
+
+class RateLimiter:
+    """Per-host token buckets shared between processes via a locked file.
+
+    Each host in ``limits`` gets a bucket holding up to ``burst`` tokens
+    that refills at ``rate`` tokens per second, and every request takes
+    one token. Requests to other hosts aren't limited.
+
+    Interactive requests may borrow up to ``burst`` tokens ahead (i.e.
+    take the bucket negative), so they go first; background requests
+    wait until there's a whole token in the bucket.
+
+    >>> limiter = RateLimiter(wf.cachefile('ratelimits.json'),
+    ...                       {'www.example.com': (2, 5)})
+    >>> r = get('https://www.example.com/', limiter=limiter)
+
+    Args:
+        path (str): File to store the buckets in.
+        limits (dict): ``{host: (rate, burst)}``
+        interactive (bool): Whether this process's requests may borrow.
+
+    """
+
+    def __init__(self, path, limits, interactive=True):
+        """Create new :class:`RateLimiter`."""
+        self.path = path
+        self.limits = limits
+        self.interactive = interactive
+
+    def _take(self, host):
+        """Take a token for ``host`` or return seconds until one is available."""
+        rate, burst = self.limits[host]
+        floor = -burst if self.interactive else 0
+        # flock() locks are per open file, so this excludes threads too
+        with open(self.path, "a+", encoding="utf-8") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            fp.seek(0)
+            try:
+                buckets = json.loads(fp.read() or "{}")
+            except ValueError:
+                buckets = {}
+
+            now = time.time()
+            tokens, updated = buckets.get(host, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens - 1 >= floor:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (floor + 1 - tokens) / rate
+
+            buckets[host] = (tokens, now)
+            fp.seek(0)
+            fp.truncate()
+            fp.write(json.dumps(buckets))
+
+        return wait
+
+    def acquire(self, host, timeout=None):
+        """Wait for a token for ``host``.
+
+        :param host: hostname of request
+        :type host: str
+        :param timeout: seconds to wait at most
+        :type timeout: float
+        :returns: seconds spent waiting
+        :rtype: float
+        :raises RateLimited: if no token was available in time
+
+        """
+        if host not in self.limits:
+            return 0.0
+
+        start = time.monotonic()
+        while True:
+            wait = self._take(host)
+            if not wait:
+                return time.monotonic() - start
+
+            waited = time.monotonic() - start
+            if timeout is not None and waited + wait > timeout:
+                raise RateLimited(f"rate limit for {host} exceeded")
+
+            time.sleep(wait)
+
+
 class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
     """Prevent redirections."""
 
@@ -77,6 +424,1131 @@ class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
         return None
 
 
+class ConnectionPool:
+    """Persistent HTTP/1.1 connections keyed by ``(scheme, host, port)``.
+
+    Connections are handed back to the pool once their response body
+    has been read to the end, so subsequent requests to the same host
+    skip the TCP (and TLS) handshake.
+
+    Attributes:
+        maxsize (int): Idle connections kept per key.
+        idle_timeout (float): Seconds an idle connection is kept.
+        requests (int): Requests sent through the pool.
+        connections (int): New connections opened (i.e. handshakes).
+        reused (int): Requests sent over an existing connection.
+        stale (int): Reused connections the server had already closed.
+
+    """
+
+    def __init__(self, maxsize=POOL_MAXSIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        """Create new :class:`ConnectionPool`."""
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0
+        self.stale = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, factory):
+        """Return an idle connection for ``key`` or a new one.
+
+        :param key: ``(scheme, host, port)`` tuple
+        :type key: tuple
+        :param factory: callable returning a new connection
+        :type factory: callable
+        :returns: ``(connection, reused)``
+        :rtype: 2-tuple
+
+        """
+        now = time.time()
+        with self._lock:
+            self.requests += 1
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, released = idle.pop()
+                if conn.sock is not None and now - released < self.idle_timeout:
+                    self.reused += 1
+                    return conn, True
+
+                conn.close()
+
+            self.connections += 1
+
+        return factory(), False
+
+    def release(self, key, conn, reusable=True):
+        """Return ``conn`` to the pool, or close it if it can't be reused."""
+        if reusable and conn.sock is not None:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.maxsize:
+                    idle.append((conn, time.time()))
+                    return
+
+        conn.close()
+
+    def has_idle(self, key):
+        """Return ``True`` if an unexpired idle connection for ``key`` is pooled."""
+        now = time.time()
+        with self._lock:
+            return any(
+                conn.sock is not None and now - released < self.idle_timeout
+                for conn, released in self._idle.get(key, [])
+            )
+
+    def discard_stale(self, conn):
+        """Close a reused connection the server had already closed."""
+        conn.close()
+        with self._lock:
+            self.stale += 1
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, _ in idle:
+                    conn.close()
+
+            self._idle.clear()
+
+    def stats(self):
+        """Pool statistics.
+
+        :returns: ``requests``, ``connections``, ``reused`` and
+            ``handshakes_saved`` counts
+        :rtype: dict
+
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "connections": self.connections,
+                "reused": self.reused,
+                "handshakes_saved": self.reused - self.stale,
+            }
+
+
+class Timing:
+    """Where the time of one request went.
+
+    Connection phases are zero for requests sent over a reused
+    connection. After redirects, only the final request is timed.
+
+    Attributes:
+        host (str): Host the request was sent to.
+        reused (bool): Whether a pooled connection was reused.
+        dns (float): Seconds resolving the hostname.
+        connect (float): Seconds establishing the TCP connection.
+        tls (float): Seconds in the TLS handshake.
+        ttfb (float): Seconds from sending the request to the response
+            headers arriving.
+        transfer (float): Seconds reading the body.
+        bytes_read (int): Body bytes received on the wire.
+        bytes_decoded (int): Body bytes after content decoding.
+
+    """
+
+    FIELDS = ("dns", "connect", "tls", "ttfb", "transfer", "bytes_read", "bytes_decoded")
+
+    def __init__(self, host):
+        """Create new :class:`Timing`."""
+        self.host = host
+        self.reused = False
+        self.dns = 0.0
+        self.connect = 0.0
+        self.tls = 0.0
+        self.ttfb = 0.0
+        self.transfer = 0.0
+        self.bytes_read = 0
+        self.bytes_decoded = 0
+
+    @property
+    def total(self):
+        """Seconds from starting to connect to the end of the body."""
+        return self.dns + self.connect + self.tls + self.ttfb + self.transfer
+
+    def as_dict(self):
+        """Return timings as a :class:`dict`."""
+        d = {name: getattr(self, name) for name in self.FIELDS}
+        d.update(host=self.host, reused=self.reused, total=self.total)
+        return d
+
+    def __repr__(self):
+        return (
+            f"<Timing {self.host} dns={self.dns * 1000:.0f}ms "
+            f"connect={self.connect * 1000:.0f}ms tls={self.tls * 1000:.0f}ms "
+            f"ttfb={self.ttfb * 1000:.0f}ms transfer={self.transfer * 1000:.0f}ms "
+            f"{self.bytes_read}/{self.bytes_decoded} bytes>"
+        )
+
+
+class HostTimings:
+    """Per-host totals of :class:`Timing` records.
+
+    Completed responses are added to the module-level instance
+    automatically; read the totals with :func:`timing_stats`.
+
+    """
+
+    def __init__(self):
+        """Create new :class:`HostTimings`."""
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def add(self, timing):
+        """Add a :class:`Timing` to the totals of its host."""
+        with self._lock:
+            totals = self._hosts.get(timing.host)
+            if totals is None:
+                totals = self._hosts[timing.host] = dict.fromkeys(Timing.FIELDS, 0)
+                totals.update(requests=0, reused=0)
+
+            totals["requests"] += 1
+            totals["reused"] += timing.reused
+            for name in Timing.FIELDS:
+                totals[name] += getattr(timing, name)
+
+    def stats(self):
+        """Return ``{host: totals}``; phases are summed seconds."""
+        with self._lock:
+            return {host: dict(totals) for host, totals in self._hosts.items()}
+
+    def clear(self):
+        """Forget all totals."""
+        with self._lock:
+            self._hosts.clear()
+
+
+def _create_connection(address, timeout=None, source_address=None, timing=None):
+    """Like :func:`socket.create_connection`, but timing DNS and connect."""
+    host, port = address
+    start = time.perf_counter()
+    addrs = [
+        (family, sockaddr)
+        for family, _, _, _, sockaddr in socket.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM
+        )
+    ]
+    resolved = time.perf_counter()
+    sock = _connect(addrs, timeout, source_address)
+    if timing is not None:
+        timing.dns = resolved - start
+        timing.connect = time.perf_counter() - resolved
+
+    return sock
+
+
+class DNSCache:
+    """Hostname resolutions shared between processes via a file.
+
+    Connections go straight to the cached addresses of a host. If none
+    of them accepts the connection, the host is resolved again and the
+    fresh addresses are tried.
+
+    Set :data:`dns_cache` to an instance to use it for all requests:
+
+    >>> web.dns_cache = DNSCache(wf.cachefile('dns.json'))
+
+    Args:
+        path (str): File to store resolutions in.
+        ttl (float): Seconds a resolution is used for.
+
+    Attributes:
+        lookups (int): Hostnames looked up.
+        hits (int): Lookups answered from the cache.
+        saved (float): Seconds of resolution time saved by hits.
+
+    """
+
+    def __init__(self, path, ttl=DNS_TTL):
+        """Create new :class:`DNSCache`."""
+        self.path = path
+        self.ttl = ttl
+        self.lookups = 0
+        self.hits = 0
+        self.saved = 0.0
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, encoding="utf-8") as fp:
+                    fcntl.flock(fp, fcntl.LOCK_SH)
+                    self._entries = json.load(fp)
+            except (OSError, ValueError):
+                self._entries = {}
+
+        return self._entries
+
+    def _update(self, key, entry=None):
+        """Set (or without ``entry``, drop) ``key`` in the file.
+
+        The file is re-read under the lock, so entries other processes
+        wrote since it was loaded are kept. Expired ones are dropped.
+
+        """
+        with self._lock:
+            entries = self._load()
+            try:
+                # flock() locks are per open file, so this excludes threads too
+                with open(self.path, "a+", encoding="utf-8") as fp:
+                    fcntl.flock(fp, fcntl.LOCK_EX)
+                    fp.seek(0)
+                    try:
+                        entries = json.loads(fp.read() or "{}")
+                    except ValueError:
+                        entries = {}
+
+                    now = time.time()
+                    entries = {k: v for k, v in entries.items() if v["expires"] >= now}
+                    if entry is None:
+                        entries.pop(key, None)
+                    else:
+                        entries[key] = entry
+
+                    fp.seek(0)
+                    fp.truncate()
+                    fp.write(json.dumps(entries))
+            except OSError:  # pragma: no cover
+                if entry is None:
+                    entries.pop(key, None)
+                else:
+                    entries[key] = entry
+
+            self._entries = entries
+
+    def _key(self, host, port):
+        return f"{host}:{port}"
+
+    def get(self, host, port):
+        """Return cached ``(family, sockaddr)`` list for ``host`` or ``None``."""
+        with self._lock:
+            self.lookups += 1
+            entry = self._load().get(self._key(host, port))
+            if not entry or entry["expires"] < time.time():
+                return None
+
+            self.hits += 1
+            self.saved += entry["cost"]
+
+        log.debug(
+            "dns: %s from cache, saved %.0fms (hit rate %d/%d, %.0fms saved)",
+            host,
+            entry["cost"] * 1000,
+            self.hits,
+            self.lookups,
+            self.saved * 1000,
+        )
+        return [(family, tuple(sockaddr)) for family, sockaddr in entry["addrs"]]
+
+    def resolve(self, host, port):
+        """Resolve ``host`` and cache the result.
+
+        :returns: ``(family, sockaddr)`` list
+        :rtype: list
+
+        """
+        start = time.monotonic()
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        cost = time.monotonic() - start
+        addrs = [(family, sockaddr) for family, _, _, _, sockaddr in infos]
+
+        log.debug("dns: resolved %s in %.0fms", host, cost * 1000)
+        self._update(
+            self._key(host, port),
+            {"addrs": addrs, "expires": time.time() + self.ttl, "cost": cost},
+        )
+        return addrs
+
+    def forget(self, host, port):
+        """Drop cached addresses of ``host``."""
+        self._update(self._key(host, port))
+
+    def create_connection(
+        self, address, timeout=None, source_address=None, timing=None
+    ):
+        """Drop-in replacement for :func:`socket.create_connection`.
+
+        Pass a :class:`Timing` as ``timing`` to record DNS and connect times.
+
+        If the cached addresses fail, the fresh ones only get what's left
+        of ``timeout``.
+
+        """
+        host, port = address
+        start = time.perf_counter()
+        cached = self.get(host, port)
+        if cached:
+            resolved = time.perf_counter()
+            try:
+                sock = _connect(cached, timeout, source_address)
+            except OSError as err:
+                log.debug("dns: cached addresses of %s failed (%s)", host, err)
+                self.forget(host, port)
+                if timeout is not None and timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:  # pylint: disable=protected-access
+                    timeout -= time.perf_counter() - start
+                    if timeout <= 0:
+                        raise
+            else:
+                if timing is not None:
+                    timing.dns = resolved - start
+                    timing.connect = time.perf_counter() - resolved
+                return sock
+
+        start = time.perf_counter()
+        addrs = self.resolve(host, port)
+        resolved = time.perf_counter()
+        sock = _connect(addrs, timeout, source_address)
+        if timing is not None:
+            timing.dns = resolved - start
+            timing.connect = time.perf_counter() - resolved
+
+        return sock
+
+    def stats(self):
+        """Return ``lookups``, ``hits`` and ``saved`` (seconds)."""
+        return {"lookups": self.lookups, "hits": self.hits, "saved": self.saved}
+
+
+def _connect(addrs, timeout, source_address):
+    """Connect to the first of ``addrs`` that accepts, like :func:`socket.create_connection`."""
+    err = None
+    for family, sockaddr in addrs:
+        sock = None
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:  # pylint: disable=protected-access
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as exc:
+            err = exc
+            if sock is not None:
+                sock.close()
+
+    if err is not None:
+        raise err
+
+    raise OSError("getaddrinfo returns an empty list")
+
+
+class TLSSessionCache:
+    """TLS sessions of earlier connections, keyed by ``(host, port)``.
+
+    New connections to a host offer its last session, so the server can
+    resume it with an abbreviated handshake. :class:`ssl.SSLSession`
+    objects can't be serialized, so sessions only live as long as the
+    process.
+
+    Attributes:
+        full (int): Full handshakes.
+        resumed (int): Abbreviated (resumed) handshakes.
+
+    """
+
+    def __init__(self):
+        """Create new :class:`TLSSessionCache`."""
+        self.full = 0
+        self.resumed = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return session to offer for ``key`` or ``None``."""
+        with self._lock:
+            return self._sessions.get(key)
+
+    def save(self, key, sock):
+        """Remember the session of ``sock``, if it has one yet.
+
+        TLS 1.3 servers send session tickets after the handshake, so
+        call this again once a response has been read.
+
+        """
+        session = getattr(sock, "session", None)
+        if session is not None:
+            with self._lock:
+                self._sessions[key] = session
+
+    def record(self, key, sock):
+        """Count the handshake of a newly connected ``sock``."""
+        with self._lock:
+            if sock.session_reused:
+                self.resumed += 1
+            else:
+                self.full += 1
+
+        log.debug(
+            "tls: %s handshake with %s:%s (%d resumed, %d full)",
+            "resumed" if sock.session_reused else "full",
+            key[0],
+            key[1],
+            self.resumed,
+            self.full,
+        )
+        self.save(key, sock)
+
+    def stats(self):
+        """Return ``full`` and ``resumed`` handshake counts."""
+        return {"full": self.full, "resumed": self.resumed}
+
+
+_ssl_context = None
+_ssl_context_lock = threading.Lock()
+
+
+def get_ssl_context():
+    """Return the :class:`ssl.SSLContext` shared by all HTTPS connections.
+
+    Building a context (and loading CA certificates) is expensive, and
+    TLS sessions can only be resumed from the context that made them.
+
+    """
+    global _ssl_context  # pylint: disable=global-statement
+    with _ssl_context_lock:
+        if _ssl_context is None:
+            _ssl_context = ssl.create_default_context()
+            _ssl_context.set_alpn_protocols(["http/1.1"])
+
+    return _ssl_context
+
+
+def tls_stats():
+    """Return handshake statistics of :data:`tls_sessions`."""
+    return tls_sessions.stats()
+
+
+class _HTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS connection that resumes sessions from :data:`tls_sessions`."""
+
+    timing = None
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)  # pylint: disable=bad-super-call
+
+        server_hostname = self._tunnel_host or self.host
+        key = (server_hostname, self._tunnel_port or self.port)
+        start = time.perf_counter()
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=server_hostname, session=tls_sessions.get(key)
+        )
+        if self.timing is not None:
+            self.timing.tls = time.perf_counter() - start
+
+        tls_sessions.record(key, self.sock)
+
+
+class _FixtureTransport:
+    """Base class of transports that keep responses in a fixture directory."""
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+
+    def _path(self, req):
+        """Return path (without extension) of the fixture for ``req``."""
+        key = hashlib.sha1(f"{req.get_method()} {req.get_full_url()}".encode("utf-8"))
+        if req.data:
+            key.update(req.data if isinstance(req.data, bytes) else b"")
+
+        return os.path.join(self.dirpath, key.hexdigest())
+
+    @staticmethod
+    def _response(req, meta, body):
+        """Build a response to ``req`` that urllib can process."""
+        headers = http.client.HTTPMessage()
+        for key, value in meta["headers"]:
+            headers[key] = value
+
+        r = urllib.response.addinfourl(
+            io.BytesIO(body), headers, req.get_full_url(), meta["status"]
+        )
+        r.msg = meta["reason"]
+        r.reason = meta["reason"]
+        return r
+
+
+class RecordingTransport(_FixtureTransport):
+    """Transport that sends requests and records them in a fixture directory.
+
+    Status, headers and the body as sent over the wire (i.e. still
+    compressed) are saved for each request, for later replay by
+    :class:`ReplayTransport`.
+
+    >>> web.transport = RecordingTransport('fixtures')
+
+    Args:
+        dirpath (str): Directory to save recordings in.
+
+    """
+
+    def open(self, req, send):
+        """Send ``req`` with ``send`` and record the response."""
+        r = send(req)
+        body = r.read()
+        meta = {
+            "method": req.get_method(),
+            "url": req.get_full_url(),
+            "status": r.status,
+            "reason": r.reason,
+            # Body is saved de-chunked
+            "headers": [
+                (k, v) for k, v in r.getheaders() if k.lower() != "transfer-encoding"
+            ],
+        }
+
+        if not os.path.exists(self.dirpath):
+            os.makedirs(self.dirpath)
+
+        path = self._path(req)
+        with atomic_writer(path + ".body", "wb") as fp:
+            fp.write(body)
+
+        with atomic_writer(path + ".json", "w") as fp:
+            json.dump(meta, fp, indent=2)
+
+        log.debug("recorded %s %s: %s", meta["method"], meta["url"], path)
+        return self._response(req, meta, body)
+
+
+class ReplayTransport(_FixtureTransport):
+    """Transport that answers requests from recordings, without any network.
+
+    Requests that weren't recorded raise :class:`NotRecorded`.
+
+    >>> web.transport = ReplayTransport('fixtures', latency=0.2)
+
+    Args:
+        dirpath (str): Directory of recordings made by
+            :class:`RecordingTransport`.
+        latency (float): Seconds to wait before each response.
+
+    """
+
+    def __init__(self, dirpath, latency=0):
+        """Create new :class:`ReplayTransport`."""
+        super().__init__(dirpath)
+        self.latency = latency
+
+    def open(self, req, send):  # pylint: disable=unused-argument
+        """Return recorded response to ``req``."""
+        path = self._path(req)
+        try:
+            with open(path + ".json", encoding="utf-8") as fp:
+                meta = json.load(fp)
+
+            with open(path + ".body", "rb") as fp:
+                body = fp.read()
+        except OSError as err:
+            raise NotRecorded(
+                f"no recording of {req.get_method()} {req.get_full_url()}"
+            ) from err
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        return self._response(req, meta, body)
+
+
+class ProxyTransport:
+    """Transport that sends requests via a local caching proxy.
+
+    The proxy (see :mod:`workflow.proxy`) is sent the full URL over
+    plain HTTP on localhost and makes the upstream request itself, so
+    responses it has cached or is already fetching are shared between
+    processes. If the proxy isn't running, requests are sent directly.
+
+    >>> web.transport = ProxyTransport(('127.0.0.1', 8118))
+
+    Args:
+        address (tuple): ``(host, port)`` the proxy listens on.
+
+    """
+
+    def __init__(self, address):
+        """Create new :class:`ProxyTransport`."""
+        self.address = f"{address[0]}:{address[1]}"
+
+    def open(self, req, send):
+        """Send ``req`` to the proxy, or with ``send`` if it's down."""
+        proxied = copy.copy(req)
+        proxied.type = "http"
+        proxied.host = self.address
+        proxied.selector = req.full_url
+        try:
+            return _network_open(None, http.client.HTTPConnection, proxied)
+        except urllib.error.URLError as err:
+            if not isinstance(err.reason, ConnectionRefusedError):
+                raise
+
+            log.debug("proxy at %s is down, sending request directly", self.address)
+            return send(req)
+
+
+# Shared by all requests made through this module
+pool = ConnectionPool()
+tls_sessions = TLSSessionCache()
+
+# Set to a `RecordingTransport` or `ReplayTransport` to record or replay
+# all requests
+transport = None
+
+# Set to a `DNSCache` to resolve hostnames through it
+dns_cache = None
+
+
+def pool_stats():
+    """Return statistics of the shared :class:`ConnectionPool`."""
+    return pool.stats()
+
+
+# Totals of all completed responses
+host_timings = HostTimings()
+
+# Callables that are passed each completed :class:`Response`,
+# e.g. to log or export its :attr:`~Response.timing`
+timing_hooks = []
+
+
+def timing_stats():
+    """Return per-host timing totals of completed responses."""
+    return host_timings.stats()
+
+
+def preconnect(url, timeout=10):
+    """Open a pooled connection to the host of ``url`` ahead of requests.
+
+    Does nothing if an idle connection to the host is already pooled.
+
+    :param url: URL of (any page on) the host
+    :type url: str
+    :param timeout: connect timeout in seconds
+    :type timeout: float
+    :returns: ``True`` if a connection was opened
+    :rtype: bool
+
+    """
+    parts = urllib.parse.urlsplit(url)
+    key = _pool_key(parts.scheme, parts.netloc)
+    if pool.has_idle(key):
+        return False
+
+    if parts.scheme == "https":
+        conn = _HTTPSConnection(parts.netloc, timeout=timeout, context=get_ssl_context())
+    else:
+        conn = http.client.HTTPConnection(parts.netloc, timeout=timeout)
+
+    conn.response_class = _PooledResponse
+    conn.timing = Timing(parts.hostname)
+    create = dns_cache.create_connection if dns_cache is not None else _create_connection
+    conn._create_connection = functools.partial(  # pylint: disable=protected-access
+        create, timing=conn.timing
+    )
+    try:
+        conn.connect()
+    except socket.timeout as err:
+        conn.close()
+        raise ConnectTimeout(f"connecting to {parts.netloc} timed out") from err
+    except OSError:
+        conn.close()
+        raise
+
+    pool.release(key, conn)
+    log.debug("preconnected to %s (%r)", parts.netloc, conn.timing)
+    return True
+
+
+class _PooledResponse(http.client.HTTPResponse):
+    """HTTP response that hands its connection back once fully read."""
+
+    _release = None
+    _aborted = False
+
+    def close(self):
+        # Body not exhausted: the connection can't carry another request
+        if self.fp is not None:
+            self._aborted = True
+
+        super().close()
+
+    def _close_conn(self):
+        super()._close_conn()
+        release, self._release = self._release, None
+        if release is not None:
+            release(reusable=not (self._aborted or self.will_close))
+
+
+def _discard_body(fp):
+    """Read and close what's left of an error response, releasing its connection.
+
+    Nobody reads the body of an error, but until it has been read, a
+    pooled connection can't carry another request.
+    """
+    if fp is None:
+        return
+
+    try:
+        fp.read(MAX_ERROR_BODY)
+    except (OSError, http.client.HTTPException):
+        pass
+    finally:
+        # Drops the connection if the body was longer
+        fp.close()
+
+
+def _pool_key(scheme, host):
+    """Return ``(scheme, host, port)`` pool key for ``host``."""
+    split = urllib.parse.urlsplit("//" + host)
+    port = split.port or (443 if scheme == "https" else 80)
+    return (scheme, split.hostname, port)
+
+
+def _pooled_open(handler, http_class, req, **http_conn_args):
+    """Like ``AbstractHTTPHandler.do_open``, but over pooled connections.
+
+    Requests go through :data:`transport` if one is set, unless the
+    request has a ``transport`` attribute of its own (``None`` to send
+    it directly).
+
+    """
+    via = getattr(req, "transport", transport)
+    if via is not None:
+        return via.open(
+            req, functools.partial(_network_open, handler, http_class, **http_conn_args)
+        )
+
+    return _network_open(handler, http_class, req, **http_conn_args)
+
+
+def _network_open(handler, http_class, req, **http_conn_args):
+    """Send ``req`` over a pooled connection."""
+    # Tunnelled (proxied HTTPS) connections are left to urllib
+    if req._tunnel_host:  # pylint: disable=protected-access
+        return handler.do_open(http_class, req, **http_conn_args)
+
+    host = req.host
+    if not host:
+        raise urllib.error.URLError("no host given")
+
+    headers = dict(req.unredirected_hdrs)
+    headers.update({k: v for k, v in req.headers.items() if k not in headers})
+    headers["Connection"] = "keep-alive"
+    headers = {name.title(): val for name, val in headers.items()}
+
+    def new_connection():
+        conn = http_class(host, timeout=req.timeout, **http_conn_args)
+        conn.response_class = _PooledResponse
+        conn.timing = timing
+        create = dns_cache.create_connection if dns_cache is not None else _create_connection
+        conn._create_connection = functools.partial(  # pylint: disable=protected-access
+            create, timing=timing
+        )
+        return conn
+
+    read_timeout = getattr(req, "read_timeout", req.timeout)
+    key = _pool_key(req.type, host)
+    while True:
+        timing = Timing(urllib.parse.urlsplit(req.full_url).hostname)
+        conn, reused = pool.acquire(key, new_connection)
+        timing.reused = reused
+
+        try:
+            if conn.sock is None:
+                try:
+                    conn.connect()
+                except socket.timeout as err:
+                    raise ConnectTimeout(f"connecting to {host} timed out") from err
+
+            # Connect timeout covers TCP and TLS handshakes only
+            conn.sock.settimeout(read_timeout)
+
+            try:
+                sent = time.perf_counter()
+                conn.request(
+                    req.get_method(),
+                    req.selector,
+                    req.data,
+                    headers,
+                    encode_chunked=req.has_header("Transfer-encoding"),
+                )
+                r = conn.getresponse()
+                timing.ttfb = time.perf_counter() - sent
+            except socket.timeout as err:
+                raise ReadTimeout(f"reading from {host} timed out") from err
+            except (ConnectionError, http.client.BadStatusLine):
+                # Server closed the idle connection; retry on a fresh one
+                if reused:
+                    pool.discard_stale(conn)
+                    continue
+
+                raise
+        except Timeout:
+            conn.close()
+            raise
+        except OSError as err:
+            conn.close()
+            raise urllib.error.URLError(err)
+        except:
+            conn.close()
+            raise
+
+        break
+
+    if isinstance(conn.sock, ssl.SSLSocket):
+        # Pick up any session ticket sent after the handshake
+        tls_sessions.save((conn.host, conn.port), conn.sock)
+
+    r._release = functools.partial(pool.release, key, conn)  # pylint: disable=protected-access
+    r.url = req.get_full_url()
+    r.msg = r.reason
+    r.timing = timing
+
+    # Nothing to read: release the connection straight away
+    if r.length == 0 or req.get_method() == "HEAD":
+        r.read()
+
+    return r
+
+
+class PooledHTTPHandler(urllib.request.HTTPHandler):
+    """Open ``http`` URLs over keep-alive connections from :data:`pool`."""
+
+    def http_open(self, req):
+        return _pooled_open(self, http.client.HTTPConnection, req)
+
+
+class PooledHTTPSHandler(urllib.request.HTTPSHandler):
+    """Open ``https`` URLs over keep-alive connections from :data:`pool`."""
+
+    def https_open(self, req):
+        return _pooled_open(
+            self, _HTTPSConnection, req, context=self._context or get_ssl_context()
+        )
+
+
+class HTTPCache:
+    """On-disk store of response bodies and their validators.
+
+    Pass an instance as the ``cache`` argument of :func:`get` to make
+    the request conditional (``If-None-Match``/``If-Modified-Since``).
+    If the server answers ``304 Not Modified``, the stored body is
+    returned as a normal ``200`` :class:`Response` (with
+    :attr:`Response.from_cache` set). Only responses that carry an
+    ``ETag`` or ``Last-Modified`` header are stored, and only once
+    their :attr:`~Response.content` has been read.
+
+    Loading an entry marks it as recently used, and :meth:`prune`
+    deletes the least recently used beyond ``max_entries``.
+
+    >>> cache = HTTPCache(wf.cachefile('http'))
+    >>> r = get('https://example.com/image.png', cache=cache)
+    >>> cache.prune()
+
+    Args:
+        dirpath (str): Directory to store responses in.
+        max_entries (int): Number of responses to keep when pruning.
+
+    """
+
+    def __init__(self, dirpath, max_entries=HTTP_CACHE_MAX_ENTRIES):
+        """Create new :class:`HTTPCache`."""
+        self.dirpath = dirpath
+        self.max_entries = max_entries
+        self.stored = 0
+
+    def _path(self, url):
+        """Return path (without extension) of cache entry for ``url``."""
+        return os.path.join(
+            self.dirpath, hashlib.sha1(url.encode("utf-8")).hexdigest()
+        )
+
+    def load(self, url):
+        """Return stored metadata for ``url`` or ``None``.
+
+        :param url: URL of cached response
+        :type url: str
+        :returns: ``status``, ``reason``, ``headers`` and ``url``
+        :rtype: dict or ``None``
+
+        """
+        path = self._path(url)
+        try:
+            with open(path + ".json", encoding="utf-8") as fp:
+                meta = json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+        if not os.path.exists(path + ".body"):
+            return None
+
+        try:
+            os.utime(path + ".json")
+        except OSError:
+            pass
+
+        return meta
+
+    def body(self, url):
+        """Return stored body for ``url``.
+
+        :param url: URL of cached response
+        :type url: str
+        :rtype: bytes
+
+        """
+        with open(self._path(url) + ".body", "rb") as fp:
+            return fp.read()
+
+    def store(self, url, response, filepath=None):
+        """Save ``response`` and its (decoded) content for ``url``.
+
+        :param url: URL the response was requested from
+        :type url: str
+        :param response: response whose content has been read
+        :type response: :class:`Response`
+        :param filepath: file the content was saved to instead of
+            being read into memory
+        :type filepath: str
+
+        """
+        if not os.path.exists(self.dirpath):
+            os.makedirs(self.dirpath)
+
+        path = self._path(url)
+        meta = {
+            "url": response.url,
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": [
+                (k, v)
+                for k, v in response.headers.items()
+                # Body is stored decoded
+                if k.lower() not in ("content-encoding", "content-length")
+            ],
+        }
+        with atomic_writer(path + ".body", "wb") as fp:
+            if filepath:
+                with open(filepath, "rb") as src:
+                    shutil.copyfileobj(src, fp, CONTENT_CHUNK_SIZE)
+            else:
+                fp.write(response.content)
+
+        with atomic_writer(path + ".json", "w") as fp:
+            json.dump(meta, fp)
+
+        self.stored += 1
+
+    def prune(self):
+        """Delete the least recently used responses beyond ``max_entries``."""
+        if not self.stored:
+            return
+
+        try:
+            entries = [e for e in os.scandir(self.dirpath) if e.name.endswith(".json")]
+        except OSError:
+            return
+
+        excess = len(entries) - self.max_entries
+        if excess <= 0:
+            return
+
+        def used(entry):
+            try:
+                return entry.stat().st_mtime
+            except OSError:  # pruned by another process
+                return 0
+
+        for entry in sorted(entries, key=used)[:excess]:
+            path = entry.path[: -len(".json")]
+            for filepath in (path + ".json", path + ".body"):
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def conditional_headers(meta):
+        """Return validator headers for a stored entry.
+
+        :param meta: metadata returned by :meth:`load`
+        :type meta: dict
+        :rtype: dict
+
+        """
+        headers = CaseInsensitiveDictionary(dict(meta["headers"]))
+        conditional = {}
+        if headers.get("etag"):
+            conditional["If-None-Match"] = headers["etag"]
+
+        if headers.get("last-modified"):
+            conditional["If-Modified-Since"] = headers["last-modified"]
+
+        return conditional
+
+
+class _DeflateDecoder:
+    """Decoder for ``deflate``, which servers send zlib-wrapped or raw."""
+
+    def __init__(self):
+        self._obj = zlib.decompressobj()
+        self._first = True
+
+    def decompress(self, data):
+        if self._first and data:
+            self._first = False
+            try:
+                return self._obj.decompress(data)
+            except zlib.error:
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        return self._obj.decompress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+class _BrotliDecoder:
+    """Decoder for ``br`` (works with ``brotli`` and ``brotlicffi``)."""
+
+    def __init__(self):
+        self._obj = brotli.Decompressor()
+
+    def decompress(self, data):
+        if hasattr(self._obj, "process"):
+            return self._obj.process(data)
+
+        return self._obj.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+def _get_decoder(coding):
+    """Return incremental decoder for content ``coding`` or ``None``.
+
+    Decoders have ``decompress(data)`` and ``flush()`` methods.
+
+    """
+    if coding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    if coding == "deflate":
+        return _DeflateDecoder()
+
+    if coding == "br" and brotli is not None:
+        return _BrotliDecoder()
+
+    if coding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    return None
+
+
 # Adapted from https://gist.github.com/babakness/3901174
 class CaseInsensitiveDictionary(dict):
     """Dictionary with caseless key search.
@@ -153,11 +1625,17 @@ class CaseInsensitiveDictionary(dict):
 
 
 class Request(urllib.request.Request):
-    """Subclass of :class:`urllib.request.Request` that supports custom methods."""
+    """Subclass of :class:`urllib.request.Request` that supports custom methods.
+
+    Also carries its own ``timeout`` (seconds or a ``(connect, read)``
+    tuple), which is applied to its connection rather than process-wide.
+
+    """
 
     def __init__(self, *args, **kwargs):
         """Create a new :class:`Request`."""
         self._method = kwargs.pop("method", None)
+        self.timeout, self.read_timeout = _split_timeout(kwargs.pop("timeout", None))
         urllib.request.Request.__init__(self, *args, **kwargs)
 
     def get_method(self):
@@ -183,12 +1661,19 @@ class Response:
 
     """
 
-    def __init__(self, request, stream=False):  # pylint: disable=redefined-outer-name
+    def __init__(
+        self, request, stream=False, opener=None, max_bytes=None
+    ):  # pylint: disable=redefined-outer-name
         """Call `request` with :mod:`urllib` and process results.
 
         :param request: :class:`Request` instance
         :param stream: Whether to stream response or retrieve it all at once
         :type stream: bool
+        :param opener: opener to use instead of the shared default
+        :type opener: :class:`urllib.request.OpenerDirector`
+        :param max_bytes: raise :class:`ResponseTooLarge` if the (decoded)
+            body is larger than this
+        :type max_bytes: int
 
         """
         self.request = request
@@ -202,14 +1687,23 @@ class Response:
         self.headers = CaseInsensitiveDictionary()
         self._content = None
         self._content_loaded = False
-        self._gzipped = False
+        self._codings = []
+        self.bytes_read = 0
+        self.bytes_decoded = 0
+        self.max_bytes = max_bytes
+        self._cache = None
+        self.from_cache = False
+        self.timing = None
 
         # Execute query
+        start = time.perf_counter()
         try:
             # pylint: disable=consider-using-with
-            self.raw = urllib.request.urlopen(request)
+            self.raw = (opener or _get_opener()).open(request, timeout=request.timeout)
         except urllib.error.HTTPError as err:
             self.error = err
+            self.timing = getattr(err.fp, "timing", None)
+            _discard_body(err.fp)
 
             try:
                 self.url = err.geturl()
@@ -224,6 +1718,14 @@ class Response:
         else:
             self.status_code = self.raw.getcode()
             self.url = self.raw.geturl()
+            self.timing = getattr(self.raw, "timing", None)
+
+        # Not sent over a pooled connection (e.g. replayed or proxied)
+        if self.timing is None:
+            self.timing = Timing(urllib.parse.urlsplit(request.full_url).hostname)
+            self.timing.ttfb = time.perf_counter() - start
+
+        self._received = time.perf_counter()
         self.reason = RESPONSES.get(self.status_code)
 
         # Parse additional info if request succeeded
@@ -235,14 +1737,21 @@ class Response:
             for key in list(headers.keys()):
                 self.headers[key.lower()] = headers.get(key)
 
-            # Is content gzipped?
+            # Is content compressed?
             # Transfer-Encoding appears to not be used in the wild
             # (contrary to the HTTP standard), but no harm in testing
             # for it
-            if "gzip" in headers.get("content-encoding", "") or "gzip" in headers.get(
-                "transfer-encoding", ""
-            ):
-                self._gzipped = True
+            for name in ("transfer-encoding", "content-encoding"):
+                for coding in headers.get(name, "").split(","):
+                    coding = coding.strip().lower()
+                    if _get_decoder(coding) is not None:
+                        self._codings.append(coding)
+
+            # Don't start reading a body that's already too big on the wire
+            length = headers.get("content-length")
+            if max_bytes is not None and length and length.isdigit():
+                if int(length) > max_bytes:
+                    self._too_large()
 
     @property
     def stream(self):
@@ -292,15 +1801,15 @@ class Response:
 
         """
         if not self._content:
-            # Decompress gzipped content
-            if self._gzipped:
-                decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
-                self._content = decoder.decompress(self.raw.read())
-            else:
-                self._content = self.raw.read()
-
+            # Decompress as it's read, so the whole compressed body is
+            # never held in memory alongside the decompressed one
+            self._content = b"".join(self._iter_decoded(CONTENT_CHUNK_SIZE))
             self._content_loaded = True
 
+            if self._cache is not None:
+                cache, url = self._cache
+                cache.store(url, self)
+
         return self._content
 
     @property
@@ -351,31 +1860,101 @@ class Response:
             if data:  # pragma: no cover
                 yield data
 
-        def generate():
-            if self._gzipped:
-                decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = self._iter_decoded(chunk_size)
 
-            while True:
-                chunk = self.raw.read(chunk_size)
+        if decode_unicode and self.encoding:
+            chunks = decode_stream(chunks, self)
 
-                if not chunk:
-                    break
+        return chunks
 
-                if self._gzipped:
-                    chunk = decoder.decompress(chunk)
+    def _iter_decoded(self, chunk_size):
+        """Read body from :attr:`raw` and undo any content codings.
 
-                yield chunk
+        Updates :attr:`bytes_read` (bytes on the wire) and
+        :attr:`bytes_decoded` as it goes.
 
-        chunks = generate()
+        """
+        # Codings are listed in the order they were applied
+        decoders = [_get_decoder(coding) for coding in reversed(self._codings)]
 
-        if decode_unicode and self.encoding:
-            chunks = decode_stream(chunks, self)
+        # A streamed body is passed on as it arrives rather than in whole
+        # chunk_size blocks, so the consumer can work during the transfer
+        read = self.raw.read
+        if self.stream and hasattr(self.raw, "read1"):
+            read = self.raw.read1
 
-        return chunks
+        while True:
+            try:
+                chunk = read(chunk_size)
+            except socket.timeout as err:
+                raise ReadTimeout(f"reading from {self.url} timed out") from err
+
+            if not chunk:
+                # read1() leaves a finished response open; read() closes
+                # it, handing its connection back to the pool
+                self.raw.read()
+                break
+
+            self.bytes_read += len(chunk)
+            for decoder in decoders:
+                chunk = decoder.decompress(chunk)
+
+            if chunk:
+                self.bytes_decoded += len(chunk)
+                self._check_size()
+                yield chunk
+
+        tail = b""
+        for decoder in decoders:
+            tail = (decoder.decompress(tail) if tail else b"") + decoder.flush()
+
+        if tail:
+            self.bytes_decoded += len(tail)
+            self._check_size()
+            yield tail
+
+        timing = self.timing
+        timing.transfer = time.perf_counter() - self._received
+        timing.bytes_read = self.bytes_read
+        timing.bytes_decoded = self.bytes_decoded
+        host_timings.add(timing)
+        for hook in timing_hooks:
+            hook(self)
+
+        log.debug(
+            "%s: %d bytes on wire, %d decoded (%s), dns %.0fms, connect %.0fms, "
+            "tls %.0fms, ttfb %.0fms, transfer %.0fms",
+            self.url,
+            self.bytes_read,
+            self.bytes_decoded,
+            ", ".join(self._codings) or "identity",
+            timing.dns * 1000,
+            timing.connect * 1000,
+            timing.tls * 1000,
+            timing.ttfb * 1000,
+            timing.transfer * 1000,
+        )
+
+    def _check_size(self):
+        """Abort download if more than :attr:`max_bytes` have been decoded."""
+        if self.max_bytes is not None and self.bytes_decoded > self.max_bytes:
+            self._too_large()
+
+    def _too_large(self):
+        """Close connection and raise :class:`ResponseTooLarge`."""
+        # Closing an unfinished response keeps its connection out of the pool
+        self.raw.close()
+        raise ResponseTooLarge(
+            f"response from {self.url} is larger than {self.max_bytes} bytes",
+            self.max_bytes,
+        )
 
     def save_to_path(self, filepath):
         """Save retrieved data to file at ``filepath``.
 
+        Data are written to disk as they are received, and the file only
+        appears at ``filepath`` once the download has completed.
+
         :param filepath: Path to save retrieved data.
 
         """
@@ -387,10 +1966,29 @@ class Response:
 
         self.stream = True
 
-        with open(filepath, "wb") as fileobj:
-            for data in self.iter_content():
+        with atomic_writer(filepath, "wb") as fileobj:
+            for data in self.iter_content(CONTENT_CHUNK_SIZE):
                 fileobj.write(data)
 
+        self._content_loaded = True
+
+        if self._cache is not None:
+            cache, url = self._cache
+            cache.store(url, self, filepath)
+
+    async def asave_to_path(self, filepath):
+        """Save retrieved data to file at ``filepath`` from a coroutine.
+
+        Like :meth:`save_to_path`, but the body is read and written on a
+        worker thread of the asyncio interface, so awaiting it never
+        blocks the event loop.
+
+        :param filepath: Path to save retrieved data.
+
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(_get_executor(), self.save_to_path, filepath)
+
     def raise_for_status(self):
         """Raise stored error if one occurred.
 
@@ -399,6 +1997,33 @@ class Response:
         if self.error is not None:
             raise self.error
 
+    def _use_cached(self, cache, url, meta):
+        """Turn a ``304 Not Modified`` into the response stored in ``cache``.
+
+        :param cache: cache the entry was loaded from
+        :type cache: :class:`HTTPCache`
+        :param url: URL of cached response
+        :type url: str
+        :param meta: metadata returned by :meth:`HTTPCache.load`
+        :type meta: dict
+
+        """
+        self.error = None
+        self.from_cache = True
+        self.url = meta["url"]
+        self.status_code = meta["status"]
+        self.reason = meta["reason"]
+        self.headers = CaseInsensitiveDictionary(meta["headers"])
+        self.mimetype = self.headers.get("content-type")
+
+        msg = http.client.HTTPMessage()
+        if self.mimetype:
+            msg["content-type"] = self.mimetype
+
+        self.transfer_encoding = msg.get_content_charset()
+        self.raw = io.BytesIO(cache.body(url))
+        self._codings = []
+
     def _get_encoding(self):
         """Get encoding from HTTP headers or content.
 
@@ -406,11 +2031,10 @@ class Response:
         :rtype: str or ``None``
 
         """
-        headers = self.raw.info()
         encoding = None
 
-        if headers.get_content_charset():
-            encoding = headers.get_content_charset()
+        if self.transfer_encoding:
+            encoding = self.transfer_encoding
 
         if not self.stream:  # Try sniffing response content
             # Encoding declared in document should override HTTP headers
@@ -448,6 +2072,33 @@ class Response:
         return encoding
 
 
+_openers = {}
+_openers_lock = threading.Lock()
+
+
+def _get_opener(allow_redirects=True):
+    """Return shared opener, building it on first use.
+
+    :param allow_redirects: follow redirections
+    :type allow_redirects: bool
+    :rtype: :class:`urllib.request.OpenerDirector`
+
+    """
+    with _openers_lock:
+        if allow_redirects not in _openers:
+            handlers = [
+                urllib.request.ProxyHandler(urllib.request.getproxies()),
+                PooledHTTPHandler(),
+                PooledHTTPSHandler(),
+            ]
+            if not allow_redirects:
+                handlers.append(NoRedirectHandler())
+
+            _openers[allow_redirects] = urllib.request.build_opener(*handlers)
+
+        return _openers[allow_redirects]
+
+
 def request(
     method,
     url,
@@ -460,6 +2111,9 @@ def request(
     timeout=60,
     allow_redirects=False,
     stream=False,
+    cache=None,
+    limiter=None,
+    max_bytes=None,
 ):
     """Initiate an HTTP(S) request. Returns :class:`Response` object.
 
@@ -481,12 +2135,22 @@ def request(
     :type files: dict
     :param auth: username, password
     :type auth: tuple
-    :param timeout: connection timeout limit in seconds
-    :type timeout: int
+    :param timeout: connect and read timeout in seconds, or a
+        ``(connect, read)`` tuple. Raises :class:`ConnectTimeout` or
+        :class:`ReadTimeout` when exceeded.
+    :type timeout: float or tuple
     :param allow_redirects: follow redirections
     :type allow_redirects: bool
     :param stream: Stream content instead of fetching it all at once.
     :type stream: bool
+    :param cache: revalidate ``GET`` requests against this cache
+    :type cache: :class:`HTTPCache`
+    :param limiter: wait for this rate limiter (at most the connect
+        timeout) before sending the request
+    :type limiter: :class:`RateLimiter`
+    :param max_bytes: abort with :class:`ResponseTooLarge` as soon as the
+        body is known to be larger than this
+    :type max_bytes: int
     :returns: Response object
     :rtype: :class:`Response`
 
@@ -506,25 +2170,6 @@ def request(
       will be used.
 
     """
-    socket.setdefaulttimeout(timeout)
-
-    # Default handlers
-    openers = [urllib.request.ProxyHandler(urllib.request.getproxies())]
-
-    if not allow_redirects:
-        openers.append(NoRedirectHandler())
-
-    if auth is not None:  # Add authorisation handler
-        username, password = auth
-        password_manager = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        password_manager.add_password(None, url, username, password)
-        auth_manager = urllib.request.HTTPBasicAuthHandler(password_manager)
-        openers.append(auth_manager)
-
-    # Install our custom chain of openers
-    opener = urllib.request.build_opener(*openers)
-    urllib.request.install_opener(opener)
-
     if not headers:
         headers = CaseInsensitiveDictionary()
     else:
@@ -533,10 +2178,18 @@ def request(
     if "User-Agent" not in headers:
         headers["User-Agent"] = USER_AGENT
 
-    # Accept gzip-encoded content
+    authorization = None
+    if auth is not None and "Authorization" not in headers:
+        username, password = auth
+        credentials = base64.b64encode(f"{username}:{password}".encode("utf-8"))
+        authorization = "Basic " + credentials.decode("ascii")
+
+    # Accept compressed content
     encodings = [s.strip() for s in headers.get("Accept-Encoding", "").split(",")]
-    if "gzip" not in encodings:
-        encodings.append("gzip")
+    encodings = [s for s in encodings if s]
+    for coding in ACCEPT_ENCODINGS:
+        if coding not in encodings:
+            encodings.append(coding)
 
     headers["Accept-Encoding"] = ", ".join(encodings)
 
@@ -568,8 +2221,32 @@ def request(
         query = urllib.parse.urlencode(params, doseq=True)
         url = urllib.parse.urlunsplit((scheme, netloc, path, query, fragment))
 
-    req = Request(url, data, headers, method=method)
-    return Response(req, stream)
+    meta = None
+    if cache is not None and method == "GET":
+        meta = cache.load(url)
+        if meta:
+            for key, value in cache.conditional_headers(meta).items():
+                if key not in headers:
+                    headers[key] = value
+
+    req = Request(url, data, headers, method=method, timeout=timeout)
+    if authorization is not None:
+        # Unredirected, so credentials aren't sent on to another host
+        req.add_unredirected_header("Authorization", authorization)
+    if limiter is not None:
+        limiter.acquire(urllib.parse.urlsplit(url).hostname, timeout=req.timeout)
+
+    r = Response(req, stream, _get_opener(allow_redirects), max_bytes)
+
+    if cache is not None and method == "GET":
+        if r.status_code == 304 and meta:
+            r._use_cached(cache, url, meta)  # pylint: disable=protected-access
+        elif r.status_code == 200 and (
+            "etag" in r.headers or "last-modified" in r.headers
+        ):
+            r._cache = (cache, url)  # pylint: disable=protected-access
+
+    return r
 
 
 def get(
@@ -580,6 +2257,9 @@ def get(
     timeout=60,
     allow_redirects=True,
     stream=False,
+    cache=None,
+    limiter=None,
+    max_bytes=None,
 ):
     """Initiate a GET request. Arguments as for :func:`request`.
 
@@ -595,6 +2275,9 @@ def get(
         timeout=timeout,
         allow_redirects=allow_redirects,
         stream=stream,
+        cache=cache,
+        limiter=limiter,
+        max_bytes=max_bytes,
     )
 
 
@@ -679,6 +2362,234 @@ def put(
     )
 
 
+class _DaemonExecutor(concurrent.futures.Executor):
+    """Thread pool whose workers are daemon threads.
+
+    :class:`~concurrent.futures.ThreadPoolExecutor` joins its workers at
+    exit, so a request nobody waits for anymore (e.g. one abandoned at a
+    deadline) would keep the process alive until it timed out.
+
+    """
+
+    def __init__(self, max_workers, thread_name_prefix):
+        """Create new :class:`_DaemonExecutor`."""
+        self._max_workers = max_workers
+        self._thread_name_prefix = thread_name_prefix
+        self._queue = queue.SimpleQueue()
+        self._threads = []
+        self._idle = threading.Semaphore(0)
+        self._lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):  # pylint: disable=arguments-differ
+        """Run ``fn(*args, **kwargs)`` on a worker and return its future."""
+        future = concurrent.futures.Future()
+        self._queue.put((future, fn, args, kwargs))
+        with self._lock:
+            # Start a worker unless one is idle, as ThreadPoolExecutor does
+            if not self._idle.acquire(blocking=False) and len(self._threads) < self._max_workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name=f"{self._thread_name_prefix}_{len(self._threads)}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+
+        return future
+
+    def _work(self):
+        while True:
+            future, fn, args, kwargs = self._queue.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as exc:  # pylint: disable=broad-except
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+            del future, fn, args, kwargs
+            self._idle.release()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Return thread pool used by the asyncio interface."""
+    global _executor  # pylint: disable=global-statement
+    with _executor_lock:
+        if _executor is None:
+            _executor = _DaemonExecutor(ASYNC_MAX_WORKERS, thread_name_prefix="web")
+
+    return _executor
+
+
+def _request_and_read(*args, **kwargs):
+    """Call :func:`request` and read the body unless streaming."""
+    r = request(*args, **kwargs)
+    if not r.stream and r.error is None:
+        r.content  # pylint: disable=pointless-statement
+
+    return r
+
+
+async def arequest(method, url, *args, **kwargs):
+    """Initiate an HTTP(S) request from a coroutine. Arguments as for :func:`request`.
+
+    The request runs on a worker thread and, unless ``stream`` is set,
+    the body is read (and decompressed) there too, so awaiting the
+    :class:`Response` never blocks the event loop.
+
+    :returns: :class:`Response` instance
+
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_executor(), functools.partial(_request_and_read, method, url, *args, **kwargs)
+    )
+
+
+async def aget(
+    url,
+    params=None,
+    headers=None,
+    auth=None,
+    timeout=60,
+    allow_redirects=True,
+    stream=False,
+    cache=None,
+    limiter=None,
+    max_bytes=None,
+):
+    """Initiate a GET request from a coroutine. Arguments as for :func:`request`.
+
+    :returns: :class:`Response` instance
+
+    """
+    return await arequest(
+        "GET",
+        url,
+        params,
+        headers=headers,
+        auth=auth,
+        timeout=timeout,
+        allow_redirects=allow_redirects,
+        stream=stream,
+        cache=cache,
+        limiter=limiter,
+        max_bytes=max_bytes,
+    )
+
+
+async def gather(*aws, limit=8, return_exceptions=False, timeout=None):
+    """Like :func:`asyncio.gather`, but with at most ``limit`` awaitables running.
+
+    If ``timeout`` is given, awaitables still running after that many
+    seconds are cancelled (their result is a
+    :class:`asyncio.CancelledError` if ``return_exceptions`` is set).
+
+    >>> urls = ['https://example.com/a.png', 'https://example.com/b.png']
+    >>> responses = asyncio.run(gather(*(aget(url) for url in urls)))
+
+    :param aws: awaitables, e.g. :func:`aget` calls
+    :param limit: maximum number running concurrently
+    :type limit: int
+    :param return_exceptions: return exceptions instead of raising
+    :type return_exceptions: bool
+    :param timeout: seconds to wait for all awaitables
+    :type timeout: float
+    :returns: results in the same order as ``aws``
+    :rtype: list
+
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    tasks = [asyncio.ensure_future(run(aw)) for aw in aws]
+    if timeout is not None and tasks:
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+    return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+
+
+def _close_response(future):
+    """Close the response of a request nobody is waiting for anymore."""
+    if not future.cancelled() and future.exception() is None:
+        r = future.result()
+        if r.raw is not None:
+            r.raw.close()
+
+
+def hedged_request(method, url, delay, *args, deadline=None, **kwargs):
+    """Initiate a request, duplicating it if it's slow to respond.
+
+    If the response headers haven't arrived after ``delay`` seconds, a
+    second, identical request is sent. Whichever answers first is used
+    and the other is closed when it completes. If the first request
+    fails before then, its error is raised without sending a duplicate.
+    Other arguments are as for :func:`request`.
+
+    :param delay: seconds to wait before sending the duplicate
+    :type delay: float
+    :param deadline: no duplicate is sent if this expires before
+        ``delay`` is up, and the duplicate's timeout is capped at the
+        time it has left
+    :type deadline: :class:`Deadline`
+    :returns: ``(response, info)`` where ``info`` has the keys ``hedged``
+        (whether a duplicate was sent), ``hedge_won`` (whether the
+        duplicate answered first) and ``latency`` (seconds from the
+        first request to the headers that were used)
+    :rtype: 2-tuple
+
+    """
+    executor = _get_executor()
+    start = time.monotonic()
+    first = executor.submit(request, method, url, *args, **kwargs)
+    info = {"hedged": False, "hedge_won": False, "latency": 0.0}
+
+    # Not first.result(timeout=...): timeouts of the request itself are
+    # TimeoutErrors too, and mustn't be taken for the delay running out
+    hedge = deadline is None or deadline.remaining() > delay
+    if hedge:
+        concurrent.futures.wait([first], timeout=delay)
+    if first.done() or not hedge:
+        r = first.result()
+        info["latency"] = time.monotonic() - start
+        return r, info
+
+    info["hedged"] = True
+    if deadline is not None:
+        kwargs["timeout"] = deadline.timeout(kwargs.get("timeout"))
+    second = executor.submit(request, method, url, *args, **kwargs)
+    pending = {first, second}
+    winner = None
+    while pending and winner is None:
+        done, pending = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in (first, second):
+            if future in done and future.exception() is None:
+                winner = future
+                break
+
+    info["latency"] = time.monotonic() - start
+    if winner is None:  # both failed
+        first.result()
+
+    info["hedge_won"] = winner is second
+    for future in (first, second):
+        if future is not winner:
+            future.add_done_callback(_close_response)
+
+    return winner.result(), info
+
+
 def _encode_multipart_formdata(fields, files):
     """Encode form data (``fields``) and ``files`` for POST request.
 